@@ -0,0 +1,367 @@
+import os
+import sys
+import json
+import time
+import types
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import itertools
+import threading
+import statistics
+import multiprocessing
+import http.server
+import psutil
+
+# Offline end-to-end benchmark: the bot's handlers and workers run against a fake Telegram client
+# and a local HTTP server, so changes to the queue, progress or upload paths can be compared run to run.
+
+SIZE_UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if text.endswith(unit): return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+def parse_mix(text):
+    # "1MB:3,20MB:1" -> three 1 MB files for every 20 MB one
+    mix = []
+    for item in text.split(','):
+        size, _, weight = item.partition(':')
+        mix.append((size.strip().upper(), parse_size(size), float(weight or 1)))
+    return mix
+
+# --- Local media server: /r/... advertises byte ranges (segmented path), /p/... does not (yt-dlp generic path) ---
+class MediaHandler(http.server.BaseHTTPRequestHandler):
+    root = None
+    bandwidth = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) != 3 or parts[0] not in ('r', 'p') or not os.path.exists(os.path.join(self.root, parts[1])):
+            self.send_error(404)
+            return None
+        path = os.path.join(self.root, parts[1])
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        ranged = parts[0] == 'r'
+        if ranged and self.headers.get('Range', '').startswith('bytes='):
+            first, _, last = self.headers['Range'][6:].partition('-')
+            start, end = int(first or 0), min(int(last or size - 1), size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        if ranged: self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return path, start, end
+
+    def do_HEAD(self):
+        self.send_head()
+
+    def do_GET(self):
+        head = self.send_head()
+        if not head: return
+        path, start, end = head
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                chunk = f.read(min(256 * 1024, left))
+                if not chunk: break
+                started = time.time()
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                left -= len(chunk)
+                if self.bandwidth: time.sleep(max(0, len(chunk) / self.bandwidth - (time.time() - started)))
+
+def serve_media(root, port, bandwidth):
+    MediaHandler.root, MediaHandler.bandwidth = root, bandwidth
+    http.server.ThreadingHTTPServer(('127.0.0.1', port), MediaHandler).serve_forever()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline: raise
+            time.sleep(0.05)
+
+def generate_media(root, mix):
+    block = os.urandom(1024 * 1024)
+    for label, size, _ in mix:
+        path = os.path.join(root, f"{label}.mp4")
+        with open(path, 'wb') as f:
+            for offset in range(0, size, len(block)):
+                f.write(block[:min(len(block), size - offset)])
+
+# --- Fake Telegram client: records replies and edits, simulates upload time and FloodWait ---
+class FakeClient:
+    def __init__(self, args):
+        self.args = args
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+        self.uploaded_bytes = 0
+        self.flood_waits = 0
+
+    def record(self, kind):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def new_message(self, chat_id, text=''):
+        return FakeMessage(self, chat_id, text)
+
+    async def maybe_flood(self):
+        if random.random() < self.args.flood_rate:
+            from pyrogram.errors import FloodWait
+            self.flood_waits += 1
+            raise FloodWait(value=self.args.flood_wait)
+
+    async def upload(self, path, progress):
+        # Pyrogram reports progress per uploaded chunk; ten steps are enough for the renderer.
+        size = os.path.getsize(path)
+        seconds = self.args.upload_latency + (size / self.args.upload_bandwidth if self.args.upload_bandwidth else 0)
+        if random.random() < self.args.flood_rate:
+            # Short waits are slept through inside Pyrogram (sleep_threshold), so uploads only get slower.
+            self.flood_waits += 1
+            seconds += self.args.flood_wait
+        for step in range(1, 11):
+            await asyncio.sleep(seconds / 10)
+            if progress: await progress(size * step // 10, size)
+        self.uploaded_bytes += size
+
+    async def resolve_peer(self, peer_id):
+        return peer_id
+
+    async def get_messages(self, chat_id, message_id):
+        return self.new_message(chat_id)
+
+class FakeMessage:
+    def __init__(self, client, chat_id, text=''):
+        self.client = client
+        self.id = next(client.message_ids)
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.from_user = types.SimpleNamespace(id=chat_id)
+        self.text = text
+        self.reply_to_message = None
+        self.video = self.audio = self.photo = self.document = None
+
+    async def reply_text(self, text, **kwargs):
+        self.client.record('reply_text')
+        return self.client.new_message(self.chat.id, text)
+
+    async def edit_text(self, text, **kwargs):
+        self.client.record('edit_text')
+        await self.client.maybe_flood()
+        self.text = text
+
+    async def delete(self):
+        self.client.record('delete')
+
+    async def reply_cached_media(self, file_id, **kwargs):
+        self.client.record('reply_cached_media')
+        return self.client.new_message(self.chat.id)
+
+    async def reply_media_group(self, media, **kwargs):
+        self.client.record('reply_media_group')
+        return [self.client.new_message(self.chat.id) for _ in media]
+
+    async def send_media(self, kind, path, progress=None):
+        self.client.record(f'reply_{kind}')
+        await self.client.upload(path, progress)
+        sent = self.client.new_message(self.chat.id)
+        setattr(sent, kind, types.SimpleNamespace(file_id=f"bench-{kind}-{sent.id}"))
+        return sent
+
+    async def reply_video(self, video, progress=None, **kwargs):
+        return await self.send_media('video', video, progress)
+
+    async def reply_audio(self, audio, progress=None, **kwargs):
+        return await self.send_media('audio', audio, progress)
+
+    async def reply_document(self, document, progress=None, **kwargs):
+        return await self.send_media('document', document, progress)
+
+    async def reply_photo(self, photo, progress=None, **kwargs):
+        return await self.send_media('photo', photo, progress)
+
+# --- Benchmark run ---
+def peak_rss_sampler(state, exclude_pid):
+    process = psutil.Process()
+    while not state['stop']:
+        try:
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                if child.pid != exclude_pid: rss += child.memory_info().rss
+            state['peak_rss'] = max(state['peak_rss'], rss)
+        except psutil.Error:
+            pass
+        time.sleep(0.2)
+
+def percentile(values, q):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+async def run_benchmark(args, mix, port, server_pid):
+    import main
+    client = FakeClient(args)
+    main.app = client
+    main.file_cache_init()
+    main.journal_open()
+    main.start_job_pool()
+
+    results = {}
+    done = asyncio.Event()
+
+    def record(waiter, ok):
+        results[waiter['id']] = {'ok': ok, 'latency': time.time() - waiter['added_time']}
+        if len(results) >= args.tasks: done.set()
+
+    finish_waiter, fail_waiter = main.finish_waiter, main.fail_waiter
+
+    async def timed_finish_waiter(waiter):
+        record(waiter, ok=True)
+        await finish_waiter(waiter)
+
+    async def timed_fail_waiter(task, waiter, error):
+        record(waiter, ok=False)
+        await fail_waiter(task, waiter, error)
+
+    main.finish_waiter, main.fail_waiter = timed_finish_waiter, timed_fail_waiter
+
+    rss = {'stop': False, 'peak_rss': 0}
+    threading.Thread(target=peak_rss_sampler, args=(rss, server_pid), daemon=True).start()
+    await main.start_workers()
+
+    labels, weights = [label for label, _, _ in mix], [weight for _, _, weight in mix]
+    modes = ['r', 'p'] if args.server == 'mixed' else ['r' if args.server == 'ranges' else 'p']
+    started = time.time()
+    for i in range(args.tasks):
+        label = random.choices(labels, weights)[0]
+        url = f"http://127.0.0.1:{port}/{modes[i % len(modes)]}/{label}.mp4/{i}"
+        await main.link_handler(client, client.new_message(i % args.users + 1, url))
+        if args.arrival_rate: await asyncio.sleep(1 / args.arrival_rate)
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"Timed out after {args.timeout}s with {len(results)}/{args.tasks} tasks finished.", file=sys.stderr)
+    elapsed = time.time() - started
+    rss['stop'] = True
+
+    latencies = [r['latency'] for r in results.values() if r['ok']]
+    return {
+        'config': {
+            'tasks': args.tasks, 'users': args.users, 'mix': args.mix, 'server': args.server,
+            'arrival_rate': args.arrival_rate, 'max_workers': main.MAX_WORKERS, 'max_upload_workers': main.MAX_UPLOAD_WORKERS,
+            'process_pool_workers': main.PROCESS_POOL_WORKERS, 'segmented_connections': main.SEGMENTED_CONNECTIONS,
+            'progress_edits_per_sec': main.PROGRESS_EDITS_PER_SEC, 'progress_min_interval': main.PROGRESS_MIN_INTERVAL,
+            'upload_latency': args.upload_latency, 'upload_bandwidth': args.upload_bandwidth, 'server_bandwidth': args.server_bandwidth,
+            'flood_rate': args.flood_rate, 'flood_wait': args.flood_wait,
+        },
+        'completed': sum(1 for r in results.values() if r['ok']),
+        'failed': sum(1 for r in results.values() if not r['ok']),
+        'elapsed': round(elapsed, 3),
+        'tasks_per_minute': round(len(latencies) / elapsed * 60, 2) if elapsed else 0,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_mean': statistics.mean(latencies) if latencies else None,
+        'edits': client.calls.get('edit_text', 0),
+        'flood_waits': client.flood_waits,
+        'calls': client.calls,
+        'uploaded_bytes': client.uploaded_bytes,
+        'peak_rss': rss['peak_rss'],
+        'concurrency': {stage: {'limit': state['limiter'].limit, 'max': state['max'], 'last_decision': state['last_decision'] and state['last_decision'][1]}
+                        for stage, state in main.CONCURRENCY.items()},
+        'stages': {stage: {'count': h['count'], 'mean': h['sum'] / h['count']} for stage, h in main.METRICS['stage_seconds'].items()},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark for the downloader bot.")
+    parser.add_argument('--tasks', type=int, default=20, help="number of links to submit")
+    parser.add_argument('--users', type=int, default=4, help="number of distinct chats submitting links")
+    parser.add_argument('--mix', default="1MB:3,16MB:1", help="file sizes and weights, e.g. 1MB:3,16MB:1")
+    parser.add_argument('--server', choices=('ranges', 'plain', 'mixed'), default='mixed', help="serve files with byte ranges, without, or alternate")
+    parser.add_argument('--server-bandwidth', type=float, default=0, help="per-connection server bandwidth in MB/s (0 = unlimited)")
+    parser.add_argument('--arrival-rate', type=float, default=0, help="links submitted per second (0 = all at once)")
+    parser.add_argument('--workers', type=int, help="MAX_WORKERS for this run")
+    parser.add_argument('--upload-workers', type=int, help="MAX_UPLOAD_WORKERS for this run")
+    parser.add_argument('--upload-latency', type=float, default=0.5, help="fixed seconds per simulated upload")
+    parser.add_argument('--upload-bandwidth', type=float, default=20, help="simulated upload bandwidth in MB/s (0 = unlimited)")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="probability of a FloodWait per edit or upload")
+    parser.add_argument('--flood-wait', type=int, default=2, help="seconds carried by each simulated FloodWait")
+    parser.add_argument('--timeout', type=float, default=600, help="give up after this many seconds")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default="benchmark_results.json", help="JSON file the results are appended to")
+    args = parser.parse_args()
+    args.upload_bandwidth *= 1024 ** 2
+    random.seed(args.seed)
+    mix = parse_mix(args.mix)
+    output = os.path.abspath(args.output)
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    media_root = os.path.join(workdir, "media")
+    os.makedirs(media_root)
+    generate_media(media_root, mix)
+
+    port = free_port()
+    server = multiprocessing.Process(target=serve_media, args=(media_root, port, args.server_bandwidth * 1024 ** 2), daemon=True)
+    server.start()
+    wait_for_port(port)
+
+    # main.py reads its configuration at import time; the caches and journal go to the scratch directory.
+    os.environ.setdefault("API_ID", "1")
+    os.environ.setdefault("API_HASH", "benchmark")
+    os.environ.setdefault("BOT_TOKEN", "1:benchmark")
+    if args.workers: os.environ["MAX_WORKERS"] = str(args.workers)
+    if args.upload_workers: os.environ["MAX_UPLOAD_WORKERS"] = str(args.upload_workers)
+    os.environ["FILE_CACHE_PATH"] = os.path.join(workdir, "file_cache.db")
+    os.environ["TASK_JOURNAL_PATH"] = os.path.join(workdir, "tasks.journal")
+    os.environ.setdefault("METRICS_PORT", "0")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    import logging
+    logging.disable(logging.INFO)
+
+    try:
+        result = asyncio.run(run_benchmark(args, mix, port, server.pid))
+    finally:
+        # The media server, yt-dlp worker processes and their manager would otherwise outlive os._exit below.
+        for child in psutil.Process().children(recursive=True):
+            child.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+    result['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    runs = []
+    if os.path.exists(output):
+        with open(output) as f: runs = json.load(f)
+    runs.append(result)
+    with open(output, 'w') as f: json.dump(runs, f, indent=2)
+
+    print(f"Completed {result['completed']}/{args.tasks} ({result['failed']} failed) in {result['elapsed']:.1f}s")
+    print(f"Throughput: {result['tasks_per_minute']} tasks/min")
+    if result['latency_p50'] is not None:
+        print(f"Latency: p50 {result['latency_p50']:.2f}s | p95 {result['latency_p95']:.2f}s")
+    print(f"Edits: {result['edits']} | FloodWaits: {result['flood_waits']} | Peak RSS: {result['peak_rss'] / 1024 ** 2:.1f} MB")
+    print(f"Results appended to {output}")
+    os._exit(0)  # worker tasks and the job pool are not meant to be shut down cleanly
+
+if __name__ == "__main__":
+    main()
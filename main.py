@@ -2,19 +2,37 @@
 # === COMPLETE AND CORRECTED main.py FOR ADVANCED DOWNLOAD BOT ===
 # =================================================================
 
+import time
+STARTUP_T0 = time.perf_counter()  # before the heavy imports below
+
 import os
 import logging
 import asyncio
-import time
 import re
 import uuid
 import psutil
-import subprocess
 import json
+import copy
+import contextlib
+import importlib
+import sqlite3
+import shutil
+import signal
+import threading
+import multiprocessing
+import mimetypes
+import urllib.request
+import urllib.error
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, urlunsplit, unquote
 from dotenv import load_dotenv
 from pyrogram import Client, filters
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-import yt_dlp
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId, FileType
+from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaVideo, InputMediaAudio
 from functools import partial
 
 # --- 1. Configuration & Basic Setup ---
@@ -26,6 +44,40 @@ API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 COOKIES_FILE_PATH = os.getenv("COOKIES_FILE_PATH")
+MAX_WORKERS = max(1, int(os.getenv("MAX_WORKERS", "6")))
+MAX_UPLOAD_WORKERS = max(1, int(os.getenv("MAX_UPLOAD_WORKERS", "4")))
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "1") not in ("0", "false", "no")
+CONCURRENCY_INTERVAL = max(1, float(os.getenv("CONCURRENCY_INTERVAL", "15")))
+CONCURRENCY_TOLERANCE = float(os.getenv("CONCURRENCY_TOLERANCE", "0.1"))
+UPLOAD_QUEUE_SIZE = max(1, int(os.getenv("UPLOAD_QUEUE_SIZE", str(MAX_UPLOAD_WORKERS))))
+INFO_CACHE_TTL = int(os.getenv("INFO_CACHE_TTL", "1800"))
+INFO_CACHE_SIZE = max(1, int(os.getenv("INFO_CACHE_SIZE", "256")))
+FILE_CACHE_PATH = os.getenv("FILE_CACHE_PATH", "file_cache.db")
+FILE_CACHE_MAX_ENTRIES = int(os.getenv("FILE_CACHE_MAX_ENTRIES", "5000"))
+FILE_CACHE_MAX_AGE = float(os.getenv("FILE_CACHE_MAX_AGE_DAYS", "30")) * 86400
+TASK_JOURNAL_PATH = os.getenv("TASK_JOURNAL_PATH", "tasks.journal")
+JOURNAL_COMPACT_EVERY = max(1, int(os.getenv("JOURNAL_COMPACT_EVERY", "200")))
+PROCESS_POOL_WORKERS = int(os.getenv("PROCESS_POOL_WORKERS", "0"))
+SEGMENTED_CONNECTIONS = int(os.getenv("SEGMENTED_CONNECTIONS", "4"))
+SEGMENTED_MIN_SIZE = int(float(os.getenv("SEGMENTED_MIN_SIZE_MB", "8")) * 1024 * 1024)
+SEGMENT_MIN_LENGTH = 1024 * 1024
+SEGMENT_RETRIES = 5
+TG_MAX_UPLOAD = int(float(os.getenv("TG_MAX_UPLOAD_MB", "2000")) * 1024 * 1024)
+SPLIT_PART_SIZE = int(float(os.getenv("SPLIT_PART_MB", "1900")) * 1024 * 1024)
+PARALLEL_PART_UPLOADS = max(1, int(os.getenv("PARALLEL_PART_UPLOADS", "3")))
+YDL_POOL_SIZE = max(1, int(os.getenv("YDL_POOL_SIZE", str(MAX_WORKERS))))
+PLAYLIST_MAX_ENTRIES = max(1, int(os.getenv("PLAYLIST_MAX_ENTRIES", "50")))
+MAX_DOWNLOAD_SIZE = int(float(os.getenv("MAX_DOWNLOAD_SIZE_MB", "0")) * 1024 * 1024)
+DISK_MIN_FREE = int(float(os.getenv("DISK_MIN_FREE_MB", "500")) * 1024 * 1024)
+MEMORY_MIN_FREE = int(float(os.getenv("MEMORY_MIN_FREE_MB", "200")) * 1024 * 1024)
+DEFAULT_TASK_RESERVE = int(float(os.getenv("DEFAULT_TASK_RESERVE_MB", "200")) * 1024 * 1024)
+STALE_FILE_AGE = float(os.getenv("STALE_FILE_HOURS", "6")) * 3600
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_SAMPLE_INTERVAL = float(os.getenv("METRICS_SAMPLE_INTERVAL", "5"))
+PROGRESS_EDITS_PER_SEC = max(0.1, float(os.getenv("PROGRESS_EDITS_PER_SEC", "5")))
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "3"))
+ADMIN_IDS = [int(i) for i in os.getenv("ADMIN_IDS", "").replace(' ', '').split(',') if i]
 
 if not all([API_ID, API_HASH, BOT_TOKEN]):
     logger.critical("FATAL ERROR: API_ID, API_HASH, or BOT_TOKEN is missing in .env file. Exiting.")
@@ -38,10 +90,51 @@ if not os.path.isdir('downloads'):
 app = Client("advanced_downloader_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
 # --- 3. Global Variables & Helper Functions ---
-TASK_QUEUE = asyncio.Queue()
+class FairTaskQueue:
+    # Round-robin across users: each user has their own FIFO and users take turns.
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._not_empty = asyncio.Event()
+
+    def qsize(self):
+        return sum(len(q) for q in self._queues.values())
+
+    async def put(self, task, front=False):
+        tasks = self._queues.setdefault(task['user_id'], deque())
+        if front:
+            tasks.appendleft(task)
+        else:
+            tasks.append(task)
+        self._not_empty.set()
+
+    async def get(self):
+        while not self._queues:
+            await self._not_empty.wait()
+        user_id, tasks = next(iter(self._queues.items()))
+        task = tasks.popleft()
+        if tasks:
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+        if not self._queues:
+            self._not_empty.clear()
+        return task
+
+    def positions(self):
+        queues = [list(q) for q in self._queues.values()]
+        order = []
+        for depth in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[depth] for q in queues if depth < len(q))
+        return {task['id']: pos for pos, task in enumerate(order, start=1)}
+
+TASK_QUEUE = FairTaskQueue()
+UPLOAD_QUEUE = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
 ACTIVE_TASKS = {}
 URL_REGEX = r'(https?://\S+)'
+PLAYLIST_URL_REGEX = r'youtube\.com/(?:playlist\?|@|channel/|c/|user/)'
+YOUTUBE_ID_REGEX = r'(?:v=|youtu\.be/|shorts/|embed/|live/)([\w-]{11})'
 BOT_START_TIME = time.time()
+STARTUP_STATS = {'imports': time.perf_counter() - STARTUP_T0}
 
 def humanbytes(size):
     if not size: return ""
@@ -62,43 +155,1026 @@ def get_readable_time(seconds):
             result += f'{int(period_value)}{period_name}'
     return result if result else '0s'
 
-last_edit_time = {}
-async def progress_callback(description, message_to_edit, current, total):
-    message_id = message_to_edit.id
+# --- Info cache: extracted info_dicts shared by link_handler and the download stage ---
+INFO_CACHE = OrderedDict()
+INFO_CACHE_STATS = {'hits': 0, 'misses': 0, 'expired': 0, 'extract_time': 0.0, 'extract_count': 0}
+
+def info_cache_expiry(info_dict):
+    # Signed format URLs carry their own expiry (`expire=` / `/expire/`); never trust the cache past it.
+    expires_at = time.time() + INFO_CACHE_TTL
+    for f in info_dict.get('formats') or []:
+        match = re.search(r'[?&/]expire[=/](\d+)', f.get('url') or '')
+        if match:
+            expires_at = min(expires_at, int(match.group(1)) - 60)
+    return expires_at
+
+def info_cache_put(video_id, info_dict):
+    INFO_CACHE[video_id] = (info_cache_expiry(info_dict), yt_dlp.YoutubeDL.sanitize_info(info_dict, remove_private_keys=True))
+    INFO_CACHE.move_to_end(video_id)
+    while len(INFO_CACHE) > INFO_CACHE_SIZE:
+        INFO_CACHE.popitem(last=False)
+
+def info_cache_get(video_id):
+    entry = INFO_CACHE.get(video_id)
+    if entry and entry[0] > time.time():
+        INFO_CACHE.move_to_end(video_id)
+        INFO_CACHE_STATS['hits'] += 1
+        return copy.deepcopy(entry[1])
+    if entry:
+        del INFO_CACHE[video_id]
+        INFO_CACHE_STATS['expired'] += 1
+    INFO_CACHE_STATS['misses'] += 1
+    return None
+
+def info_cache_saved_time():
+    if not INFO_CACHE_STATS['extract_count']: return 0
+    return INFO_CACHE_STATS['hits'] * INFO_CACHE_STATS['extract_time'] / INFO_CACHE_STATS['extract_count']
+
+async def extract_info_cached(url, profile, video_id):
+    info_dict = info_cache_get(video_id) if video_id else None
+    if info_dict: return info_dict
+    start = time.time()
+    info_dict = await run_extract_job(url, profile)
+    INFO_CACHE_STATS['extract_time'] += time.time() - start
+    observe_stage('extract', time.time() - start)
+    INFO_CACHE_STATS['extract_count'] += 1
+    if video_id: info_cache_put(video_id, info_dict)
+    return info_dict
+
+async def download_with_cached_info(task, ydl_job):
+    video_id = task.get('video_id')
+    info_dict = info_cache_get(video_id) if video_id else None
+    if info_dict:
+        try:
+            return await run_download_job(task, ydl_job, info_dict)
+        except yt_dlp.utils.DownloadError as e:
+            # Same fallback as yt-dlp's --load-info-json: stale signed URLs -> extract again from the page.
+            logger.info(f"Cached info for {video_id} failed ({e}), re-extracting.")
+            INFO_CACHE.pop(video_id, None)
+    info_dict, filepath, pp_seconds = await run_download_job(task, ydl_job)
+    if video_id: info_cache_put(video_id, info_dict)
+    return info_dict, filepath, pp_seconds
+
+# --- Result cache: Telegram file_ids of finished uploads, persisted in SQLite ---
+FILE_CACHE_DB = None
+
+def normalize_url(url):
+    id_match = re.search(YOUTUBE_ID_REGEX, url)
+    if id_match and ("youtube.com" in url or "youtu.be" in url):
+        return f"youtube:{id_match.group(1)}"
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/') or '/', parts.query, ''))
+
+def media_cache_key(url, format_id='best', media_type='auto'):
+    return f"{normalize_url(url)}|{format_id}|{media_type}"
+
+def file_cache_init():
+    global FILE_CACHE_DB
+    FILE_CACHE_DB = sqlite3.connect(FILE_CACHE_PATH)
+    FILE_CACHE_DB.row_factory = sqlite3.Row
+    FILE_CACHE_DB.execute("CREATE TABLE IF NOT EXISTS file_cache (cache_key TEXT PRIMARY KEY, file_id TEXT NOT NULL, media_type TEXT, file_size INTEGER, caption TEXT, created REAL, last_used REAL, hits INTEGER DEFAULT 0)")
+    FILE_CACHE_DB.execute("CREATE TABLE IF NOT EXISTS cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    FILE_CACHE_DB.commit()
+    file_cache_evict()
+
+def file_cache_bump(name, amount=1):
+    FILE_CACHE_DB.execute("INSERT INTO cache_stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, amount))
+
+def file_cache_get(cache_key, count_miss=True):
+    row = FILE_CACHE_DB.execute("SELECT * FROM file_cache WHERE cache_key = ? AND created > ?", (cache_key, time.time() - FILE_CACHE_MAX_AGE)).fetchone()
+    if row or count_miss:
+        file_cache_bump('hits' if row else 'misses')
+    if row:
+        FILE_CACHE_DB.execute("UPDATE file_cache SET last_used = ?, hits = hits + 1 WHERE cache_key = ?", (time.time(), cache_key))
+        file_cache_bump('bytes_saved', row['file_size'] or 0)
+    FILE_CACHE_DB.commit()
+    return row
+
+def file_cache_put(cache_key, media_type, file_id, file_size, caption):
     now = time.time()
-    if (now - last_edit_time.get(message_id, 0)) < 2:
+    FILE_CACHE_DB.execute("INSERT OR REPLACE INTO file_cache (cache_key, file_id, media_type, file_size, caption, created, last_used, hits) VALUES (?, ?, ?, ?, ?, ?, ?, 0)", (cache_key, file_id, media_type, file_size, caption, now, now))
+    FILE_CACHE_DB.commit()
+    file_cache_evict()
+
+def file_cache_invalidate(cache_key):
+    FILE_CACHE_DB.execute("DELETE FROM file_cache WHERE cache_key = ?", (cache_key,))
+    file_cache_bump('invalidations')
+    FILE_CACHE_DB.commit()
+
+def file_cache_evict():
+    FILE_CACHE_DB.execute("DELETE FROM file_cache WHERE created <= ?", (time.time() - FILE_CACHE_MAX_AGE,))
+    FILE_CACHE_DB.execute("DELETE FROM file_cache WHERE cache_key NOT IN (SELECT cache_key FROM file_cache ORDER BY last_used DESC LIMIT ?)", (FILE_CACHE_MAX_ENTRIES,))
+    FILE_CACHE_DB.commit()
+
+def file_cache_stats():
+    stats = {row['name']: row['value'] for row in FILE_CACHE_DB.execute("SELECT name, value FROM cache_stats")}
+    stats['entries'] = FILE_CACHE_DB.execute("SELECT COUNT(*) FROM file_cache").fetchone()[0]
+    return stats
+
+async def send_cached_media(task):
+    # A task may be looked up again by the worker; only its first miss counts towards the hit rate.
+    entry = file_cache_get(task['cache_key'], count_miss=not task.get('cache_checked'))
+    task['cache_checked'] = True
+    if not entry: return None
+    try:
+        await task['message'].reply_cached_media(entry['file_id'], caption=entry['caption'])
+        return entry
+    except Exception as e:
+        logger.warning(f"Cached file_id for {task['cache_key']} could not be resent, invalidating: {e}")
+        file_cache_invalidate(task['cache_key'])
+        return None
+
+def sent_file_id(sent_message):
+    media = sent_message and (sent_message.video or sent_message.audio or sent_message.photo or sent_message.document)
+    return media.file_id if media else None
+
+# --- Task journal: append-only log of task lifecycle, replayed after a restart ---
+JOURNAL = {'file': None, 'live': {}, 'finished': 0}
+JOURNAL_FIELDS = ('id', 'url', 'user_id', 'added_time', 'cache_key', 'is_button_click', 'media_type', 'format_id', 'video_id', 'expected_size')
+
+def journal_write(record, sync=False):
+    JOURNAL['file'].write(json.dumps(record) + "\n")
+    JOURNAL['file'].flush()
+    if sync: os.fsync(JOURNAL['file'].fileno())
+
+def journal_open():
+    if os.path.exists(TASK_JOURNAL_PATH):
+        with open(TASK_JOURNAL_PATH, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # torn final line from a crash mid-write
+                if record['op'] == 'add':
+                    JOURNAL['live'][record['task']['id']] = record['task']
+                elif record['op'] == 'status' and record['id'] in JOURNAL['live']:
+                    JOURNAL['live'][record['id']].update(record['fields'])
+                elif record['op'] == 'done':
+                    JOURNAL['live'].pop(record['id'], None)
+    journal_compact()
+    logger.info(f"Task journal opened with {len(JOURNAL['live'])} unfinished tasks.")
+
+def journal_compact():
+    tmp_path = TASK_JOURNAL_PATH + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in JOURNAL['live'].values():
+            f.write(json.dumps({'op': 'add', 'task': record}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    if JOURNAL['file']: JOURNAL['file'].close()
+    os.replace(tmp_path, TASK_JOURNAL_PATH)
+    JOURNAL['file'] = open(TASK_JOURNAL_PATH, 'a', encoding='utf-8')
+    JOURNAL['finished'] = 0
+
+def journal_add(task):
+    if not JOURNAL['file'] or task['id'] in JOURNAL['live']: return
+    record = {k: task[k] for k in JOURNAL_FIELDS if k in task}
+    record.update(chat_id=task['message'].chat.id, message_id=task['message'].id)
+    if task.get('status_message_for_edit'):
+        record['status_message_id'] = task['status_message_for_edit'].id
+    JOURNAL['live'][task['id']] = record
+    journal_write({'op': 'add', 'task': record}, sync=True)
+
+def journal_status(task):
+    if not JOURNAL['file'] or task['id'] not in JOURNAL['live']: return
+    fields = {'status': task['status']}
+    if task.get('status_message'):
+        fields['status_message_id'] = task['status_message'].id
+    JOURNAL['live'][task['id']].update(fields)
+    journal_write({'op': 'status', 'id': task['id'], 'fields': fields})
+
+def journal_done(task, result):
+    if not JOURNAL['file'] or JOURNAL['live'].pop(task['id'], None) is None: return
+    journal_write({'op': 'done', 'id': task['id'], 'result': result}, sync=True)
+    JOURNAL['finished'] += 1
+    if JOURNAL['finished'] >= JOURNAL_COMPACT_EVERY:
+        journal_compact()
+
+# --- Admission control: reserve space in downloads/ before a task may start ---
+DISK_RESERVATIONS = {}
+DEFERRED_TASKS = []
+ADMISSION_EVENT = asyncio.Event()
+
+def format_filesize(f):
+    return f.get('filesize') or f.get('filesize_approx') or 0
+
+def expected_download_size(video_id, format_id):
+    entry = INFO_CACHE.get(video_id)
+    if not entry: return 0
+    return next((format_filesize(f) for f in entry[1].get('formats') or [] if f.get('format_id') == format_id), 0)
+
+def task_disk_usage(task_id=None):
+    usage = 0
+    for name in os.listdir('downloads'):
+        if task_id is None or name.startswith(f"{task_id} - "):
+            try:
+                usage += os.path.getsize(os.path.join('downloads', name))
+            except OSError:
+                pass
+    return usage
+
+def admit_task(task):
+    # Progressive formats land as one file; merges and MP3 extraction briefly need the input and output side by side.
+    factor = 1 if task.get('is_button_click') and task.get('media_type') == 'video' else 2
+    need = (task.get('expected_size') or DEFAULT_TASK_RESERVE) * factor
+    if task.get('split'):
+        need += task['expected_size']  # the parts sit next to the original until it is removed
+    outstanding = sum(max(0, size - task_disk_usage(task_id)) for task_id, size in DISK_RESERVATIONS.items())
+    free = shutil.disk_usage('downloads').free - DISK_MIN_FREE
+    # Deferring only helps if finishing the other tasks can free enough; everything in downloads/ goes eventually.
+    reclaimable = free + task_disk_usage()
+    if need > reclaimable:
+        raise RuntimeError(f"Not enough disk space: needs {humanbytes(need)}, at most {humanbytes(max(0, reclaimable)) or '0 B'} can be freed")
+    if need > free - outstanding or psutil.virtual_memory().available < MEMORY_MIN_FREE:
+        return False
+    DISK_RESERVATIONS[task['id']] = need
+    return True
+
+def release_reservation(task):
+    DISK_RESERVATIONS.pop(task['id'], None)
+    ADMISSION_EVENT.set()
+
+async def admission_loop(interval=10):
+    # Deferred tasks wait here rather than in a worker, so they hold no download slot. They go back to the
+    # head of the queue whenever a reservation is released, and every `interval` seconds for RAM that frees up elsewhere.
+    while True:
+        ADMISSION_EVENT.clear()
+        try:
+            await asyncio.wait_for(ADMISSION_EVENT.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        while DEFERRED_TASKS:
+            await TASK_QUEUE.put(DEFERRED_TASKS.pop(), front=True)
+
+def sweep_stale_files(min_age=STALE_FILE_AGE):
+    live_ids = set(ACTIVE_TASKS) | set(JOURNAL['live'])
+    now = time.time()
+    for name in os.listdir('downloads'):
+        path = os.path.join('downloads', name)
+        try:
+            if name.split(' - ', 1)[0] in live_ids or now - os.path.getmtime(path) < min_age: continue
+            os.remove(path)
+            logger.info(f"Removed stale download {name}.")
+        except OSError as e:
+            logger.warning(f"Could not remove stale download {name}: {e}")
+
+async def housekeeping_loop():
+    while True:
+        await asyncio.sleep(STALE_FILE_AGE)
+        try:
+            await asyncio.to_thread(sweep_stale_files)
+        except Exception as e:
+            logger.error(f"Error while sweeping downloads: {e}")
+
+# --- Metrics: per-stage latency histograms, byte counters and gauges, exported Prometheus-style ---
+HISTOGRAM_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+METRICS = {'stage_seconds': {}, 'stage_bytes': {}, 'errors': {}, 'tasks': {'ok': 0, 'error': 0}}
+SYSTEM_STATS = {'cpu': 0.0, 'ram': None, 'disk': None}
+
+def observe_stage(stage, seconds, nbytes=0):
+    histogram = METRICS['stage_seconds'].setdefault(stage, {'buckets': [0] * len(HISTOGRAM_BUCKETS), 'sum': 0.0, 'count': 0})
+    for i, bound in enumerate(HISTOGRAM_BUCKETS):
+        if seconds <= bound: histogram['buckets'][i] += 1
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+    if nbytes:
+        METRICS['stage_bytes'][stage] = METRICS['stage_bytes'].get(stage, 0) + nbytes
+
+def record_task_result(waiter, ok, extractor='unknown'):
+    # Counted per request, like the ok side in finish_waiter; the extractor is the primary task's.
+    METRICS['tasks']['ok' if ok else 'error'] += 1
+    if not ok:
+        METRICS['errors'][extractor] = METRICS['errors'].get(extractor, 0) + 1
+
+def task_extractor(task):
+    # Labels come only from yt-dlp's extractor names, so odd URLs cannot mint new metric series.
+    if not task.get('extractor'):
+        entry = INFO_CACHE.get(task.get('video_id'))
+        info = task.get('info_dict') or (entry[1] if entry else {})
+        task['extractor'] = info.get('extractor_key')
+        if not task['extractor']:
+            try:
+                task['extractor'] = next((ie.ie_key() for ie in import_yt_dlp().extractor.gen_extractor_classes() if ie.suitable(task['url'])), 'unknown')
+            except Exception:
+                task['extractor'] = 'unknown'
+    return task['extractor']
+
+def metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def histogram_quantile(histogram, q):
+    # Upper bound of the bucket holding the q-th observation, like Prometheus' histogram_quantile.
+    rank = q * histogram['count']
+    for bound, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+        if count >= rank: return bound
+    return float('inf')
+
+def active_workers():
+    counts = {'download': 0, 'upload': 0}
+    for task in ACTIVE_TASKS.values():
+        if task.get('worker'):
+            counts['download' if task['worker'].startswith('D') else 'upload'] += 1
+    return counts
+
+def render_metrics():
+    lines = ["# TYPE downloader_stage_seconds histogram"]
+    for stage, histogram in METRICS['stage_seconds'].items():
+        for bound, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+            lines.append(f'downloader_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'downloader_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+        lines.append(f'downloader_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.3f}')
+        lines.append(f'downloader_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+    lines.append("# TYPE downloader_stage_bytes_total counter")
+    lines += [f'downloader_stage_bytes_total{{stage="{stage}"}} {nbytes}' for stage, nbytes in METRICS['stage_bytes'].items()]
+    lines.append("# TYPE downloader_queue_depth gauge")
+    lines.append(f'downloader_queue_depth{{queue="download"}} {TASK_QUEUE.qsize()}')
+    lines.append(f'downloader_queue_depth{{queue="upload"}} {UPLOAD_QUEUE.qsize()}')
+    lines.append("# TYPE downloader_active_workers gauge")
+    lines += [f'downloader_active_workers{{stage="{stage}"}} {count}' for stage, count in active_workers().items()]
+    lines.append("# TYPE downloader_concurrency_limit gauge")
+    lines += [f'downloader_concurrency_limit{{stage="{stage}"}} {state["limiter"].limit}' for stage, state in CONCURRENCY.items()]
+    lines.append("# TYPE downloader_transferred_bytes_total counter")
+    lines += [f'downloader_transferred_bytes_total{{stage="{stage}"}} {nbytes}' for stage, nbytes in THROUGHPUT.items()]
+    lines.append("# TYPE downloader_tasks_total counter")
+    lines += [f'downloader_tasks_total{{result="{result}"}} {count}' for result, count in METRICS['tasks'].items()]
+    lines.append("# TYPE downloader_errors_total counter")
+    lines += [f'downloader_errors_total{{extractor="{metric_label(extractor)}"}} {count}' for extractor, count in METRICS['errors'].items()]
+    lines.append("# TYPE downloader_info_cache_requests_total counter")
+    lines.append(f'downloader_info_cache_requests_total{{result="hit"}} {INFO_CACHE_STATS["hits"]}')
+    lines.append(f'downloader_info_cache_requests_total{{result="miss"}} {INFO_CACHE_STATS["misses"]}')
+    lines.append("# TYPE downloader_startup_seconds gauge")
+    lines += [f'downloader_startup_seconds{{phase="{phase}"}} {seconds:.3f}' for phase, seconds in STARTUP_STATS.items()]
+    lines.append("# TYPE downloader_system gauge")
+    lines.append(f'downloader_system{{resource="cpu_percent"}} {SYSTEM_STATS["cpu"]}')
+    if SYSTEM_STATS['ram']: lines.append(f'downloader_system{{resource="ram_percent"}} {SYSTEM_STATS["ram"].percent}')
+    if SYSTEM_STATS['disk']: lines.append(f'downloader_system{{resource="disk_percent"}} {SYSTEM_STATS["disk"].percent}')
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        if request_line.split(b' ')[1:2] == [b'/metrics']:
+            body, status = render_metrics().encode(), "200 OK"
+        else:
+            body, status = b"Not Found\n", "404 Not Found"
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+async def system_sampler():
+    # /status and /metrics read these samples, so no handler ever waits on psutil.
+    while True:
+        try:
+            SYSTEM_STATS['cpu'] = psutil.cpu_percent(interval=None)
+            SYSTEM_STATS['ram'] = await asyncio.to_thread(psutil.virtual_memory)
+            SYSTEM_STATS['disk'] = await asyncio.to_thread(psutil.disk_usage, '/')
+        except Exception as e:
+            logger.error(f"Error sampling system stats: {e}")
+        await asyncio.sleep(METRICS_SAMPLE_INTERVAL)
+
+# --- Adaptive concurrency: measured throughput drives how many download/upload workers may run ---
+THROUGHPUT = {'download': 0, 'upload': 0}
+THROUGHPUT_LOCK = threading.Lock()
+CONCURRENCY_COOLDOWN = 4  # controller intervals to hold after a probe that did not pay off
+
+class ConcurrencyLimiter:
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.changed = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self):
+        async with self.changed:
+            self.active -= 1
+            self.changed.notify_all()
+
+    async def set_limit(self, limit):
+        # Lowering only takes effect as running tasks finish; nothing is interrupted.
+        async with self.changed:
+            self.limit = limit
+            self.changed.notify_all()
+
+CONCURRENCY = {
+    stage: {'limiter': ConcurrencyLimiter(cap if not ADAPTIVE_CONCURRENCY else (cap + 1) // 2), 'max': cap,
+            'bytes': 0, 'rate': None, 'peak': 0, 'prev_rate': None, 'last_change': 0, 'next_probe': 1, 'cooldown': 0, 'last_decision': None}
+    for stage, cap in (('download', MAX_WORKERS), ('upload', MAX_UPLOAD_WORKERS))
+}
+DOWNLOAD_LIMITER = CONCURRENCY['download']['limiter']
+UPLOAD_LIMITER = CONCURRENCY['upload']['limiter']
+
+def count_throughput(stage, task, key, current):
+    # Hooks report cumulative bytes per file; only the growth since the last report is new traffic.
+    seen = task.setdefault('throughput_seen', {})
+    previous = seen.get((stage, key), 0)
+    if current < previous: previous = 0  # the transfer restarted
+    seen[(stage, key)] = current
+    with THROUGHPUT_LOCK:
+        THROUGHPUT[stage] += current - previous
+
+def stage_has_backlog(stage):
+    if stage == 'upload': return UPLOAD_QUEUE.qsize() > 0
+    # Deferred tasks wait for disk/RAM; more download slots would not start them, whether or not they are queued again.
+    return TASK_QUEUE.qsize() > sum(1 for t in ACTIVE_TASKS.values() if t['status'] == 'Deferred') - len(DEFERRED_TASKS)
+
+async def adjust_concurrency(stage, state, rate):
+    # Hill climbing: probe one worker up or down, keep going while it pays, undo it when it doesn't.
+    limiter = state['limiter']
+    limit = new_limit = limiter.limit
+    if state['cooldown']: state['cooldown'] -= 1
+    if not stage_has_backlog(stage):
+        # Without a backlog the rate only reflects demand, not what the link can do.
+        state['prev_rate'], state['last_change'] = None, 0
         return
-    last_edit_time[message_id] = now
-    
+    moved, prev, probing, reason = state['last_change'], state['prev_rate'], False, None
+    speeds = f"{humanbytes(prev) or '0 B'}/s -> {humanbytes(rate) or '0 B'}/s" if prev is not None else ""
+    if moved and prev is not None:
+        if rate > prev * (1 + CONCURRENCY_TOLERANCE):
+            if 1 <= limit + moved <= state['max']:
+                new_limit, probing, reason = limit + moved, True, f"{limit} workers raised throughput ({speeds}), trying {limit + moved}"
+        elif moved > 0:
+            new_limit, reason = limit - 1, f"worker #{limit} did not raise throughput ({speeds})"
+            state['cooldown'], state['next_probe'] = CONCURRENCY_COOLDOWN, -1
+        else:
+            # Fewer workers only stick when they are actually faster (e.g. a congested link or disk).
+            new_limit, reason = limit + 1, f"dropping to {limit} workers did not raise throughput ({speeds})"
+            state['cooldown'], state['next_probe'] = CONCURRENCY_COOLDOWN, 1
+    elif not state['cooldown']:
+        step = state['next_probe'] if 1 <= limit + state['next_probe'] <= state['max'] else -state['next_probe']
+        if 1 <= limit + step <= state['max']:
+            new_limit, probing = limit + step, True
+            reason = f"backlog at {humanbytes(rate) or '0 B'}/s, trying {new_limit} workers"
+    state['last_change'], state['prev_rate'] = (new_limit - limit if probing else 0), rate
+    if reason:
+        state['last_decision'] = (time.time(), reason)
+    if new_limit != limit:
+        await limiter.set_limit(new_limit)
+        logger.info(f"Concurrency: {stage} {limit} -> {new_limit} ({reason})")
+
+async def concurrency_controller():
+    while True:
+        await asyncio.sleep(CONCURRENCY_INTERVAL)
+        for stage, state in CONCURRENCY.items():
+            try:
+                rate = (THROUGHPUT[stage] - state['bytes']) / CONCURRENCY_INTERVAL
+                state['bytes'], state['rate'], state['peak'] = THROUGHPUT[stage], rate, max(state['peak'], rate)
+                if ADAPTIVE_CONCURRENCY: await adjust_concurrency(stage, state, rate)
+            except Exception as e:
+                logger.error(f"Error in concurrency controller ({stage}): {e}")
+
+# --- Progress rendering: hooks only record the latest state, one service does the edits ---
+PROGRESS_STATE = {}
+
+def progress_update(waiter, description, current, total, speed=None, filename=''):
+    # Finished waiters have had their status message deleted, failed ones show the error; neither gets progress again.
+    if ACTIVE_TASKS.get(waiter['id']) is not waiter or waiter['status'] == 'Error': return
+    waiter['progress'] = (description, current, total, speed, filename)
+    progress_mark(waiter)
+    if waiter.get('playlist_id'):
+        playlist_touch(waiter['playlist_id'])
+
+def progress_mark(waiter):
+    status_message = waiter.get('status_message')
+    if status_message:
+        entry = PROGRESS_STATE.get(status_message.id)
+        if entry is None:
+            entry = PROGRESS_STATE[status_message.id] = {'message': status_message, 'last_edit': 0}
+        entry['waiter'] = waiter
+        entry['dirty'] = True
+
+def progress_done(waiter):
+    waiter.pop('progress', None)
+    if waiter.get('status_message'):
+        PROGRESS_STATE.pop(waiter['status_message'].id, None)
+
+def render_progress(progress):
+    description, current, total, speed, filename = progress
     percentage = current * 100 / total
     progress_bar = "[{0}{1}]".format('█' * int(percentage / 10), '░' * (10 - int(percentage / 10)))
-    progress_text = f"**{description}**\n{progress_bar} {percentage:.2f}%\n`{humanbytes(current)} / {humanbytes(total)}`"
+    progress_text = f"**{description}**\n"
+    if filename: progress_text += f"`{filename}`\n"
+    progress_text += f"{progress_bar} {percentage:.2f}%\n`{humanbytes(current)} / {humanbytes(total)}`"
+    if speed is not None: progress_text += f"\n**Speed:** `{humanbytes(speed)}/s`"
+    return progress_text
+
+def progress_detail(waiter):
+    if not waiter.get('progress'): return waiter['status_detail']
+    _, current, total, speed, _ = waiter['progress']
+    return f"{current * 100 / total:.1f}%" + (f" ({humanbytes(speed)}/s)" if speed else "")
+
+async def progress_renderer():
+    # Oldest-first, at most PROGRESS_EDITS_PER_SEC edits overall and one per message every PROGRESS_MIN_INTERVAL.
+    logger.info("Progress renderer started.")
+    while True:
+        try:
+            now = time.time()
+            due = [e for e in list(PROGRESS_STATE.values()) if e['dirty'] and now - e['last_edit'] >= PROGRESS_MIN_INTERVAL]
+            if not due:
+                await asyncio.sleep(0.5)
+                continue
+            entry = min(due, key=lambda e: e['last_edit'])
+            progress = entry['waiter'].get('progress')
+            entry['dirty'], entry['last_edit'] = False, now
+            if progress:
+                try:
+                    await entry['message'].edit_text(entry['waiter'].get('render_progress', render_progress)(progress))
+                except FloodWait as e:
+                    logger.warning(f"FloodWait while editing progress, pausing edits for {e.value}s.")
+                    entry['dirty'] = True
+                    await asyncio.sleep(e.value)
+                except Exception:
+                    pass
+            await asyncio.sleep(1 / PROGRESS_EDITS_PER_SEC)
+        except Exception as e:
+            logger.error(f"Error in progress renderer: {e}")
+            await asyncio.sleep(1)
+
+def download_progress_hook(d, task):
+    if d['status'] in ('downloading', 'finished') and d.get('downloaded_bytes'):
+        count_throughput('download', task, d.get('filename'), d['downloaded_bytes'])
+    if d['status'] == 'downloading' or (d['status'] == 'finished' and d.get('total_bytes')):
+        total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        if total_bytes > 0:
+            for waiter in list(task['waiters']):
+                progress_update(waiter, "📥 බාගත කරමින්...", d.get('downloaded_bytes', 0), total_bytes, d.get('speed') or 0, d.get('filename', ''))
+
+async def upload_progress(task, current, total):
+    count_throughput('upload', task, task.get('filepath'), current)
+    if total > 0:
+        for waiter in list(task['waiters']):
+            progress_update(waiter, "📤 Upload කරමින්...", current, total)
+
+# --- YoutubeDL pool: yt-dlp is imported in the background and warm instances are reused per option profile ---
+yt_dlp = None
+YDL_POOL = {}
+YDL_POOL_LOCK = threading.Lock()
+YDL_POOL_STATS = {'created': 0, 'reused': 0, 'discarded': 0}
+YDL_DEFAULT_OUTTMPL = 'downloads/%(title)s.%(ext)s'
+
+def import_yt_dlp():
+    global yt_dlp
+    if yt_dlp is None:
+        yt_dlp = importlib.import_module('yt_dlp')
+    return yt_dlp
+
+def wants_cookies(url):
+    return bool(COOKIES_FILE_PATH) and os.path.exists(COOKIES_FILE_PATH) and ("youtube.com" in url or "youtu.be" in url)
+
+def ydl_profile_options(profile):
+    kind, cookies = profile
+    ydl_opts = {'quiet': True}
+    if kind != 'info':
+        ydl_opts['outtmpl'] = YDL_DEFAULT_OUTTMPL
+        if MAX_DOWNLOAD_SIZE: ydl_opts['max_filesize'] = MAX_DOWNLOAD_SIZE
+    if kind == 'video':
+        ydl_opts['merge_output_format'] = 'mp4'
+    elif kind == 'audio':
+        ydl_opts['postprocessors'] = [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}]
+    if cookies: ydl_opts['cookiefile'] = COOKIES_FILE_PATH
+    return ydl_opts
+
+def create_ydl(profile):
+    ydl = import_yt_dlp().YoutubeDL(ydl_profile_options(profile))
+    # Hooks can't be removed from a YoutubeDL, so each instance gets one permanent hook per kind
+    # that forwards to whoever has it checked out.
+    ydl.bot_hooks = {}
+    ydl.add_progress_hook(lambda d: ydl.bot_hooks['progress'](d) if 'progress' in ydl.bot_hooks else None)
+    ydl.add_postprocessor_hook(lambda d: ydl.bot_hooks['postprocessor'](d) if 'postprocessor' in ydl.bot_hooks else None)
+    YDL_POOL_STATS['created'] += 1
+    return ydl
+
+def release_ydl(profile, ydl):
+    ydl.bot_hooks = {}
+    with YDL_POOL_LOCK:
+        idle = YDL_POOL.setdefault(profile, [])
+        if len(idle) < YDL_POOL_SIZE:
+            idle.append(ydl)
+            return
+    ydl.close()
+
+@contextlib.contextmanager
+def pooled_ydl(profile, outtmpl=None, format_spec=None, **hooks):
+    with YDL_POOL_LOCK:
+        idle = YDL_POOL.get(profile)
+        ydl = idle.pop() if idle else None
+    if ydl: YDL_POOL_STATS['reused'] += 1
+    else: ydl = create_ydl(profile)
+    ydl.params['outtmpl']['default'] = outtmpl or YDL_DEFAULT_OUTTMPL
+    ydl.params['format'] = format_spec
+    ydl.format_selector = ydl.build_format_selector(format_spec) if format_spec else None
+    ydl.bot_hooks = {kind: hook for kind, hook in hooks.items() if hook}
+    try:
+        yield ydl
+    except BaseException:
+        # A failed run may leave cookies, retcodes or half-open connections behind; start clean next time.
+        YDL_POOL_STATS['discarded'] += 1
+        ydl.close()
+        raise
+    release_ydl(profile, ydl)
+
+async def warm_up_yt_dlp():
+    try:
+        await asyncio.to_thread(warm_ydl_pool)
+        logger.info(f"yt-dlp ready {STARTUP_STATS['yt_dlp_ready']:.2f}s after connecting (import {STARTUP_STATS['yt_dlp_import']:.2f}s).")
+    except Exception as e:
+        logger.error(f"Error warming up yt-dlp: {e}")
+
+def warm_ydl_pool():
+    started = time.perf_counter()
+    import_yt_dlp()
+    STARTUP_STATS['yt_dlp_import'] = time.perf_counter() - started
+    cookies = [False, True] if COOKIES_FILE_PATH and os.path.exists(COOKIES_FILE_PATH) else [False]
+    for profile in [(kind, c) for kind in ('info', 'video', 'audio') for c in cookies]:
+        release_ydl(profile, create_ydl(profile))
+    STARTUP_STATS['yt_dlp_ready'] = time.perf_counter() - started
+
+# --- Job execution: yt-dlp work runs in threads, or in worker processes when PROCESS_POOL_WORKERS > 0 ---
+JOB_POOL = None
+JOB_PROGRESS_QUEUE = None
+JOB_TASKS = {}
+CANCELLED_JOBS = {}
+JOB_RETRY_LOCK = asyncio.Lock()
+JOB_CONTEXT = {}
+
+def run_ydl_download(url, ydl_job, info_dict, progress_hook):
+    pp_timing = {'seconds': 0.0}
+    def postprocessor_hook(d):
+        if d['status'] == 'started': pp_timing['start'] = time.time()
+        elif d['status'] == 'finished': pp_timing['seconds'] += time.time() - pp_timing.pop('start', time.time())
+    with pooled_ydl(ydl_job['profile'], ydl_job['outtmpl'], ydl_job['format'], progress=progress_hook, postprocessor=postprocessor_hook) as ydl:
+        if info_dict:
+            info_dict = ydl.process_ie_result(info_dict, download=True)
+        else:
+            info_dict = ydl.extract_info(url, download=True)
+        # Post-processors (e.g. MP3 extraction) change the final path, so prefer what yt-dlp reports.
+        requested = info_dict.get('requested_downloads') or [{}]
+        return info_dict, requested[0].get('filepath') or ydl.prepare_filename(info_dict), pp_timing['seconds']
+
+def run_ydl_extract(url, profile):
+    with pooled_ydl(profile) as ydl:
+        return ydl.extract_info(url, download=False)
+
+def check_cancelled(task_id, cancelled):
+    if cancelled.pop(task_id, None):
+        raise import_yt_dlp().utils.DownloadCancelled(f"Task {task_id} was cancelled")
+
+def thread_progress_hook(d, task):
+    check_cancelled(task['id'], CANCELLED_JOBS)
+    download_progress_hook(d, task)
+
+# The functions below run inside the worker processes.
+def job_process_init(progress_queue, cancelled):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    JOB_CONTEXT.update(progress_queue=progress_queue, cancelled=cancelled, last_sent={})
+    warm_ydl_pool()
+
+def job_progress_hook(task_id, d):
+    # Only a few numbers cross the process boundary, at most twice a second per job.
+    now = time.time()
+    if d['status'] == 'downloading' and now - JOB_CONTEXT['last_sent'].get(task_id, 0) < 0.5:
+        return
+    JOB_CONTEXT['last_sent'][task_id] = now
+    check_cancelled(task_id, JOB_CONTEXT['cancelled'])
+    JOB_CONTEXT['progress_queue'].put((task_id, {k: d[k] for k in ('status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate', 'speed', 'filename') if k in d}))
+
+def download_job(task_id, url, ydl_job, info_dict):
+    try:
+        info_dict, filepath, pp_seconds = run_ydl_download(url, ydl_job, info_dict, partial(job_progress_hook, task_id))
+        return yt_dlp.YoutubeDL.sanitize_info(info_dict), filepath, pp_seconds
+    finally:
+        JOB_CONTEXT['last_sent'].pop(task_id, None)
+
+def extract_job(url, profile):
+    return yt_dlp.YoutubeDL.sanitize_info(run_ydl_extract(url, profile))
+
+# Main-process side.
+def start_job_pool():
+    global JOB_POOL, JOB_PROGRESS_QUEUE, CANCELLED_JOBS
+    if PROCESS_POOL_WORKERS <= 0: return
+    ctx = multiprocessing.get_context('spawn')
+    if JOB_PROGRESS_QUEUE is None:
+        JOB_PROGRESS_QUEUE = ctx.Queue()
+        CANCELLED_JOBS = ctx.Manager().dict()
+        threading.Thread(target=job_progress_reader, daemon=True).start()
+    JOB_POOL = ProcessPoolExecutor(PROCESS_POOL_WORKERS, mp_context=ctx, initializer=job_process_init, initargs=(JOB_PROGRESS_QUEUE, CANCELLED_JOBS))
+    logger.info(f"Started {PROCESS_POOL_WORKERS} yt-dlp worker processes.")
+
+def job_progress_reader():
+    while True:
+        try:
+            task_id, d = JOB_PROGRESS_QUEUE.get()
+            task = JOB_TASKS.get(task_id)
+            if task: download_progress_hook(d, task)
+        except Exception as e:
+            logger.error(f"Error reading job progress: {e}")
+
+async def run_job(task_id, thread_func, thread_args, pool_func, pool_args):
+    # Normally done by the startup warm-up already; results and errors from yt-dlp need the module here too.
+    if yt_dlp is None: await asyncio.to_thread(import_yt_dlp)
+    for attempt in range(2):
+        # Retries run one at a time, so a job that crashes every time cannot take the retried bystanders down again.
+        async with JOB_RETRY_LOCK if attempt else contextlib.nullcontext():
+            pool = JOB_POOL
+            try:
+                if pool is None:
+                    return await asyncio.to_thread(thread_func, *thread_args)
+                return await asyncio.wrap_future(pool.submit(pool_func, *pool_args))
+            except asyncio.CancelledError:
+                # Queued jobs are dropped by wrap_future; running ones stop at their next progress hook.
+                if task_id: CANCELLED_JOBS[task_id] = True
+                raise
+            except BrokenProcessPool:
+                # Every job on a broken pool fails, not just the crasher's; the first one to notice replaces the pool.
+                if pool is JOB_POOL:
+                    logger.error("A yt-dlp worker process died, restarting the process pool.")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    start_job_pool()
+                if attempt:
+                    raise RuntimeError("yt-dlp worker process crashed")
+                logger.warning(f"Retrying {pool_func.__name__} for {task_id or pool_args[0]} on the new process pool.")
+
+async def run_download_job(task, ydl_job, info_dict=None):
+    JOB_TASKS[task['id']] = task
     try:
-        await message_to_edit.edit_text(progress_text)
+        return await run_job(task['id'], run_ydl_download, (task['url'], ydl_job, info_dict, partial(thread_progress_hook, task=task)), download_job, (task['id'], task['url'], ydl_job, info_dict))
+    finally:
+        JOB_TASKS.pop(task['id'], None)
+
+async def run_extract_job(url, profile):
+    return await run_job(None, run_ydl_extract, (url, profile), extract_job, (url, profile))
+
+# --- Segmented downloader: parallel byte ranges for direct media links on range-capable servers ---
+SEGMENT_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, SEGMENTED_CONNECTIONS * MAX_WORKERS), thread_name_prefix="segment")
+HTTP_HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'}
+DIRECT_MEDIA_TYPES = {'video': 'video', 'audio': 'audio', 'image': 'photo'}
+
+class RangeNotSupported(IOError):
+    pass
+
+def probe_direct_link(url):
+    request = urllib.request.Request(url, method='HEAD', headers=HTTP_HEADERS)
+    with urllib.request.urlopen(request, timeout=15) as response:
+        headers, final_url = response.headers, response.geturl()
+    content_type = headers.get_content_type()
+    size = int(headers.get('Content-Length') or 0)
+    if headers.get('Accept-Ranges', '').lower() != 'bytes' or size < SEGMENTED_MIN_SIZE:
+        return None
+    media_type = DIRECT_MEDIA_TYPES.get(content_type.split('/')[0])
+    if not media_type and content_type != 'application/octet-stream':
+        return None  # HTML pages and the like are for yt-dlp's extractors
+    filename = headers.get_filename() or os.path.basename(unquote(urlsplit(final_url).path)) or 'download'
+    return {'url': final_url, 'size': size, 'filename': re.sub(r'[\\/:*?"<>|]', '_', filename), 'media_type': media_type or 'document'}
+
+def fetch_segment(url, path, start, end, state, index):
+    retries = 0
+    while True:
+        offset = offset_at_start = start + state['done'][index]
+        if offset > end: return
+        request = urllib.request.Request(url, headers=dict(HTTP_HEADERS, Range=f"bytes={offset}-{end}"))
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response, open(path, 'r+b') as f:
+                if response.status != 206:
+                    raise RangeNotSupported(f"Server ignored the range request (HTTP {response.status})")
+                f.seek(offset)
+                while offset <= end:
+                    chunk = response.read(min(256 * 1024, end - offset + 1))
+                    if not chunk: break
+                    f.write(chunk)
+                    offset += len(chunk)
+                    state['done'][index] += len(chunk)
+                    if state['failed']: return
+                    segment_progress(state)
+            if offset > end: return
+            raise IOError("Connection closed before the segment was complete")
+        except RangeNotSupported:
+            # Retrying cannot help; the worker falls back to yt-dlp.
+            state['failed'] = True
+            raise
+        except (OSError, urllib.error.URLError) as e:
+            # Only consecutive attempts without any progress count towards the retry limit.
+            retries = 1 if start + state['done'][index] > offset_at_start else retries + 1
+            if retries > SEGMENT_RETRIES or state['failed']:
+                state['failed'] = True
+                raise
+            logger.warning(f"Segment {index} of {path} failed ({e}), retry {retries}/{SEGMENT_RETRIES}.")
+            time.sleep(min(2 ** retries, 30))
+
+def segment_progress(state, status='downloading'):
+    now = time.time()
+    if status == 'downloading' and now - state['last_report'] < 0.5: return
+    state['last_report'] = now
+    check_cancelled(state['task']['id'], CANCELLED_JOBS)
+    downloaded = sum(state['done'])
+    download_progress_hook({'status': status, 'downloaded_bytes': downloaded, 'total_bytes': state['size'], 'speed': downloaded / max(now - state['start'], 0.001), 'filename': state['filename']}, state['task'])
+
+async def segmented_download(task, direct):
+    path = f"downloads/{task['id']} - {direct['filename']}"
+    task['files'].append(path)
+    with open(path, 'wb') as f:
+        f.truncate(direct['size'])
+    count = min(SEGMENTED_CONNECTIONS, max(1, direct['size'] // SEGMENT_MIN_LENGTH))
+    length = -(-direct['size'] // count)
+    state = {'task': task, 'size': direct['size'], 'filename': direct['filename'], 'done': [0] * count, 'failed': False, 'start': time.time(), 'last_report': 0}
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(*(loop.run_in_executor(SEGMENT_EXECUTOR, fetch_segment, direct['url'], path, i * length, min((i + 1) * length, direct['size']) - 1, state, i) for i in range(count)))
+    finally:
+        state['failed'] = state['failed'] or sum(state['done']) < direct['size']
+    # The throttled reports miss the tail of the file; this one counts every byte and shows 100%.
+    segment_progress(state, 'finished')
+    title, ext = os.path.splitext(direct['filename'])
+    return {'title': title, 'ext': ext.lstrip('.'), 'duration': 0, 'filesize': direct['size']}, path, 0
+
+# --- Large files: keyframe-aligned splitting and parallel part uploads ---
+def can_split(task):
+    return bool(shutil.which('ffmpeg')) and task.get('media_type') not in ('photo', 'document')
+
+async def run_command(*args):
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"{args[0]} failed: {stderr.decode(errors='ignore')[-300:]}")
+    return stdout.decode()
+
+async def media_duration(path):
+    try:
+        return float(await run_command('ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path))
+    except (RuntimeError, ValueError, OSError):
+        return 0
+
+async def split_media(task):
+    # Stream copy with the segment muxer: cuts land on keyframes, so every part plays on its own.
+    path = task['filepath']
+    size = os.path.getsize(path)
+    duration = task['info_dict'].get('duration') or await media_duration(path)
+    if not duration:
+        raise RuntimeError("Cannot split a file of unknown duration")
+    base, ext = os.path.splitext(path)
+    folder, prefix = os.path.split(f"{base} - part")
+    segment_time = duration * SPLIT_PART_SIZE / size
+    for _ in range(4):
+        await run_command('ffmpeg', '-v', 'error', '-y', '-i', path, '-map', '0:v?', '-map', '0:a?', '-c', 'copy', '-f', 'segment',
+                          '-segment_time', f"{segment_time:.3f}", '-reset_timestamps', '1', f"{base} - part%03d{ext}")
+        parts = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.startswith(prefix) and name.endswith(ext))
+        task['files'].extend(parts)
+        largest = max(os.path.getsize(p) for p in parts)
+        if largest <= TG_MAX_UPLOAD:
+            return parts
+        for p in parts: os.remove(p)
+        segment_time *= SPLIT_PART_SIZE / largest * 0.9
+    raise RuntimeError(f"Could not split the file into parts under {humanbytes(TG_MAX_UPLOAD)}")
+
+async def upload_parts(task, caption):
+    parts = task['parts']
+    is_audio = task.get('media_type') == 'audio'
+    done, total = [0] * len(parts), sum(os.path.getsize(p) for p in parts)
+    semaphore = asyncio.Semaphore(PARALLEL_PART_UPLOADS)
+    peer = await app.resolve_peer(task['message'].chat.id)
+
+    async def part_progress(current, _total, index):
+        done[index] = current
+        await upload_progress(task, sum(done), total)
+
+    async def upload_part(index, path):
+        async with semaphore:
+            duration = int(await media_duration(path))
+            uploaded = await app.save_file(path, progress=part_progress, progress_args=(index,))
+            if is_audio:
+                attribute = raw.types.DocumentAttributeAudio(duration=duration)
+            else:
+                attribute = raw.types.DocumentAttributeVideo(duration=duration, w=0, h=0, supports_streaming=True)
+            media = await app.invoke(raw.functions.messages.UploadMedia(peer=peer, media=raw.types.InputMediaUploadedDocument(
+                file=uploaded, mime_type=mimetypes.guess_type(path)[0] or ('audio/mpeg' if is_audio else 'video/mp4'),
+                attributes=[attribute, raw.types.DocumentAttributeFilename(file_name=os.path.basename(path))])))
+            document = media.document
+            file_id = FileId(file_type=FileType.AUDIO if is_audio else FileType.VIDEO, dc_id=document.dc_id, media_id=document.id,
+                             access_hash=document.access_hash, file_reference=document.file_reference).encode()
+            part_caption = f"📦 Part {index + 1}/{len(parts)}"
+            if index == 0: part_caption = f"{caption[:1000]}\n\n{part_caption}"
+            if is_audio:
+                return InputMediaAudio(file_id, caption=part_caption, duration=duration)
+            return InputMediaVideo(file_id, caption=part_caption, duration=duration)
+
+    return await asyncio.gather(*(upload_part(index, path) for index, path in enumerate(parts)))
+
+async def send_media_parts(message, media_group):
+    # Albums hold 2-10 items; a lone trailing part is sent on its own.
+    for start in range(0, len(media_group), 10):
+        chunk = media_group[start:start + 10]
+        if len(chunk) == 1:
+            await message.reply_cached_media(chunk[0].media, caption=chunk[0].caption)
+        else:
+            await message.reply_media_group(chunk)
+
+# --- Playlists: flat, lazy listing; entries are queued while later pages are still being fetched ---
+PLAYLISTS = {}
+PLAYLIST_TASKS = set()
+
+def is_playlist_url(url):
+    return bool(re.search(PLAYLIST_URL_REGEX, url))
+
+def open_playlist(url):
+    # Not pooled: the instance stays tied to the listing's page generator until the playlist is done.
+    ydl_opts = {'quiet': True, 'extract_flat': 'in_playlist', 'lazy_playlist': True}
+    if wants_cookies(url): ydl_opts['cookiefile'] = COOKIES_FILE_PATH
+    ydl = import_yt_dlp().YoutubeDL(ydl_opts)
+    try:
+        # process=False keeps `entries` as the extractor's own generator, so pages are fetched on demand.
+        info = ydl.extract_info(url, download=False, process=False)
+        for _ in range(3):
+            if info.get('_type') not in ('url', 'url_transparent'): break
+            info = ydl.extract_info(info['url'], download=False, process=False)
     except Exception:
-        pass
+        ydl.close()
+        raise
+    return ydl, info
 
-def download_progress_hook(d, status_message, task_id):
-    if d['status'] == 'downloading':
-        message_id = status_message.id
-        total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-        downloaded_bytes = d.get('downloaded_bytes', 0)
-        speed = d.get('speed', 0)
+def iter_playlist_entries(ydl, info, depth=0):
+    for entry in info.get('entries') or []:
+        if not entry: continue
+        if entry.get('_type') == 'playlist' or (entry.get('ie_key') == 'YoutubeTab' and depth < 2):
+            # Channel home pages list their tabs (Videos, Shorts, ...) as nested playlists.
+            nested = entry if entry.get('_type') == 'playlist' else ydl.extract_info(entry['url'], download=False, process=False)
+            yield from iter_playlist_entries(ydl, nested, depth + 1)
+        elif entry.get('url') or entry.get('webpage_url'):
+            yield entry
 
-        if total_bytes > 0:
-            percentage = downloaded_bytes * 100 / total_bytes
-            progress_bar = "[{0}{1}]".format('█' * int(percentage / 10), '░' * (10 - int(percentage / 10)))
-            if task_id in ACTIVE_TASKS:
-                ACTIVE_TASKS[task_id]['status_detail'] = f"{percentage:.1f}% ({humanbytes(speed)}/s)"
-            
-            global last_edit_time
-            now = time.time()
-            if (now - last_edit_time.get(message_id, 0)) < 2:
-                return
-            last_edit_time[message_id] = now
-            
-            progress_text = f"**📥 බාගත කරමින්...**\n`{d.get('filename', '')}`\n{progress_bar} {percentage:.2f}%\n`{humanbytes(downloaded_bytes)} / {humanbytes(total_bytes)}`\n**Speed:** `{humanbytes(speed)}/s`"
-            asyncio.run_coroutine_threadsafe(status_message.edit_text(progress_text), app.loop)
+def render_playlist_progress(playlist):
+    lines = [f"**📃 Playlist:** `{playlist['title']}`",
+             f"✅ `{playlist['done']}` | ❌ `{playlist['failed']}` | 📑 `{playlist['queued']}`" + (" (ලැයිස්තුව ලබාගනිමින්...)" if playlist['listing'] else "")]
+    for task in playlist['tasks']:
+        if task['status'] in ("Downloading", "Splitting", "Downloaded", "Uploading"):
+            lines.append(f"{'📤' if task['status'] == 'Uploading' else '📥'} `{(task.get('title') or task['url'])[:40]}` - `{progress_detail(task)}`")
+    return "\n".join(lines)
+
+def playlist_touch(playlist_id):
+    playlist = PLAYLISTS.get(playlist_id)
+    if playlist:
+        progress_mark(playlist)
+    return playlist
+
+async def playlist_entry_finished(task, ok):
+    playlist = playlist_touch(task.get('playlist_id'))
+    if not playlist: return
+    playlist['done' if ok else 'failed'] += 1
+    if task in playlist['tasks']: playlist['tasks'].remove(task)
+    if not playlist['listing'] and playlist['done'] + playlist['failed'] >= playlist['queued']:
+        await finish_playlist(playlist)
+
+async def finish_playlist(playlist):
+    PLAYLISTS.pop(playlist['id'], None)
+    progress_done(playlist)
+    try:
+        await playlist['status_message'].edit_text(f"**📃 Playlist:** `{playlist['title']}`\n\n✅ සම්පූර්ණයි: `{playlist['done']}` | ❌ අසාර්ථකයි: `{playlist['failed']}`")
+    except Exception:
+        pass
+
+async def ingest_playlist(message, url):
+    playlist = {'id': str(uuid.uuid4())[:8], 'title': url, 'queued': 0, 'done': 0, 'failed': 0, 'listing': True, 'tasks': [],
+                'render_progress': render_playlist_progress}
+    playlist['progress'] = playlist
+    playlist['status_message'] = await message.reply_text("📃 Playlist එකක් හඳුනාගත්තා. ලැයිස්තුව ලබාගනිමින්...", quote=True)
+    PLAYLISTS[playlist['id']] = playlist
+    ydl = None
+    try:
+        ydl, info = await asyncio.to_thread(open_playlist, url)
+        playlist['title'] = info.get('title') or url
+        entries = iter_playlist_entries(ydl, info)
+        while playlist['queued'] < PLAYLIST_MAX_ENTRIES:
+            entry = await asyncio.to_thread(next, entries, None)
+            if entry is None: break
+            entry_url = entry.get('webpage_url') or entry['url']
+            task = {'id': str(uuid.uuid4())[:8], 'url': entry_url, 'message': message, 'user_id': message.chat.id, 'status': 'Pending', 'status_detail': '',
+                    'added_time': time.time(), 'cache_key': media_cache_key(entry_url), 'playlist_id': playlist['id'], 'title': entry.get('title')}
+            if entry.get('ie_key'):
+                task['extractor'] = entry['ie_key']
+            if entry.get('ie_key') == 'Youtube' and entry.get('id'):
+                task['video_id'] = entry['id']
+            playlist['tasks'].append(task)
+            playlist['queued'] += 1
+            await enqueue_task(task)
+            playlist_touch(playlist['id'])
+    except Exception as e:
+        logger.error(f"Listing playlist {url} failed: {e}")
+        if not playlist['queued']:
+            PLAYLISTS.pop(playlist['id'], None)
+            return await playlist['status_message'].edit_text(f"❌ Playlist එක ලබාගැනීමේදී දෝෂයක් ඇතිවිය: `{e}`")
+    finally:
+        if ydl: await asyncio.to_thread(ydl.close)
+    playlist['listing'] = False
+    if playlist['done'] + playlist['failed'] >= playlist['queued']:
+        await finish_playlist(playlist)
+    else:
+        playlist_touch(playlist['id'])
 
 async def create_quality_keyboard(info_dict):
     formats = info_dict.get('formats', [])
@@ -132,62 +1208,296 @@ async def create_quality_keyboard(info_dict):
         
     return InlineKeyboardMarkup(buttons) if buttons else None
 
-# --- 4. Core Worker ---
-async def queue_worker():
-    logger.info("Queue worker started.")
+# --- 4. Core Workers (download stage -> upload stage) ---
+# Identical requests (same cache_key) share one download: later ones attach to the
+# in-flight task as waiters and each waiter gets its own status message and upload.
+INFLIGHT_TASKS = {}
+
+async def enqueue_task(task):
+    ACTIVE_TASKS[task['id']] = task
+    journal_add(task)
+    primary = INFLIGHT_TASKS.get(task['cache_key'])
+    if primary:
+        task['attached_to'] = primary['id']
+        task['status'], task['status_detail'] = primary['status'], primary['status_detail']
+        primary['waiters'].append(task)
+        if primary.get('worker') or primary['status'] != 'Pending':
+            try:
+                await ensure_status_message(task)
+            except Exception:
+                # Undo the attach so the primary never reports to a waiter that was never told about it.
+                if task in primary['waiters']: primary['waiters'].remove(task)
+                ACTIVE_TASKS.pop(task['id'], None)
+                journal_done(task, 'error')
+                raise
+        return primary
+    task['waiters'] = [task]
+    INFLIGHT_TASKS[task['cache_key']] = task
+    await TASK_QUEUE.put(task)
+    return task
+
+async def recover_tasks():
+    # Tasks keep their ID, so yt-dlp finds the old `.part` files under the same outtmpl and resumes them.
+    for record in list(JOURNAL['live'].values()):
+        try:
+            message = await app.get_messages(record['chat_id'], record['message_id'])
+            status_message = await app.get_messages(record['chat_id'], record['status_message_id']) if record.get('status_message_id') else None
+        except Exception as e:
+            logger.warning(f"Could not recover task {record['id']}: {e}")
+            message = None
+        if not message or message.empty:
+            JOURNAL['live'].pop(record['id'], None)
+            journal_write({'op': 'done', 'id': record['id'], 'result': 'lost'})
+            continue
+        task = {k: record[k] for k in JOURNAL_FIELDS if k in record}
+        task.update(message=message, status='Pending', status_detail='Restart එකෙන් පසු නැවත ආරම්භ විය')
+        if status_message and not status_message.empty:
+            task['status_message_for_edit'] = status_message
+        await enqueue_task(task)
+        logger.info(f"Recovered task {task['id']} ({task['url']}).")
+
+async def ensure_status_message(waiter):
+    # Playlist entries report through their playlist's single aggregated message.
+    if not waiter.get('status_message') and not waiter.get('playlist_id'):
+        waiter['status_message'] = waiter.get('status_message_for_edit') or await waiter['message'].reply_text("⏳ ඔබගේ ඉල්ලීම සකසමින් පවතී...", quote=True)
+    return waiter.get('status_message')
+
+def set_task_status(task, status, status_detail=''):
+    for waiter in task['waiters']:
+        progress_done(waiter)
+        waiter['status'], waiter['status_detail'] = status, status_detail
+        if status != "Error": journal_status(waiter)
+        if waiter.get('playlist_id'): playlist_touch(waiter['playlist_id'])
+
+def release_task(task):
+    if INFLIGHT_TASKS.get(task['cache_key']) is task:
+        del INFLIGHT_TASKS[task['cache_key']]
+
+def cleanup_files(task):
+    for f in task.get('files', []):
+        if os.path.exists(f): os.remove(f)
+    release_reservation(task)
+
+async def fail_task(task, error):
+    logger.error(f"Task {task['id']} failed. Error: {error}")
+    release_task(task)
+    task['worker'] = None
+    for waiter in list(task['waiters']):
+        await fail_waiter(task, waiter, error)
+
+async def fail_waiter(task, waiter, error):
+    # Served waiters leave task['waiters'], so a later failure cannot touch them again.
+    if waiter in task['waiters']: task['waiters'].remove(waiter)
+    progress_done(waiter)
+    waiter['status'], waiter['status_detail'] = "Error", ''
+    journal_done(waiter, 'error')
+    # The first lookup compiles yt-dlp's URL patterns; keep that off the event loop.
+    record_task_result(waiter, ok=False, extractor=await asyncio.to_thread(task_extractor, task))
+    await playlist_entry_finished(waiter, ok=False)
+    try:
+        if not await ensure_status_message(waiter): return
+        await waiter['status_message'].edit_text(f"❌ **බාගත කිරීමේ දෝෂයකි!**\n\nURL: `{task['url']}`\nError: `{error}`")
+    except Exception:
+        pass
+
+async def finish_waiter(waiter):
+    progress_done(waiter)
+    journal_done(waiter, 'ok')
+    record_task_result(waiter, ok=True)
+    observe_stage('total', time.time() - waiter['added_time'])
+    await playlist_entry_finished(waiter, ok=True)
+    if waiter.get('status_message'):
+        try:
+            await waiter['status_message'].delete()
+        except Exception:
+            pass
+    ACTIVE_TASKS.pop(waiter['id'], None)
+
+async def download_worker(worker_id):
+    logger.info(f"Download worker #{worker_id} started.")
     while True:
+        await DOWNLOAD_LIMITER.acquire()
         try:
             task = await TASK_QUEUE.get()
             task_id = task['id']
-            message = task['message']
             url = task['url']
             
-            status_message = task.get('status_message_for_edit') or await message.reply_text("⏳ ඔබගේ ඉල්ලීම සකසමින් පවතී...", quote=True)
-            ACTIVE_TASKS[task_id]['status'] = "Downloading"
+            try:
+                task['worker'] = f"D{worker_id}"
+                for waiter in list(task['waiters']):
+                    await ensure_status_message(waiter)
+                entry = await send_cached_media(task)
+                if entry:
+                    # Anyone who attached meanwhile is served from the same file_id.
+                    release_task(task)
+                    for waiter in task['waiters'][1:]:
+                        try:
+                            await waiter['message'].reply_cached_media(entry['file_id'], caption=entry['caption'])
+                        except Exception as e:
+                            logger.warning(f"Resending cached media to waiter {waiter['id']} failed: {e}")
+                    for waiter in task['waiters']:
+                        await finish_waiter(waiter)
+                    continue
+                if 'direct' not in task:
+                    task['direct'] = None
+                    if SEGMENTED_CONNECTIONS > 1 and not task.get('is_button_click') and "youtube.com" not in url and "youtu.be" not in url:
+                        try:
+                            task['direct'] = await asyncio.to_thread(probe_direct_link, url)
+                        except Exception as e:
+                            logger.info(f"Range probe for {url} failed, using yt-dlp: {e}")
+                    if task['direct']:
+                        task['expected_size'] = task['direct']['size']
+                        task['media_type'] = task['direct']['media_type']
+                        if MAX_DOWNLOAD_SIZE and task['expected_size'] > MAX_DOWNLOAD_SIZE:
+                            await fail_task(task, f"File is larger than {humanbytes(MAX_DOWNLOAD_SIZE)}")
+                            continue
+                    # Predict Telegram's size limit up front instead of failing after the whole download.
+                    task['split'] = (task.get('expected_size') or 0) > TG_MAX_UPLOAD
+                    if task['split'] and not can_split(task):
+                        await fail_task(task, f"File ({humanbytes(task['expected_size'])}) is larger than Telegram's {humanbytes(TG_MAX_UPLOAD)} limit and cannot be split")
+                        continue
+                if not admit_task(task):
+                    task['worker'] = None
+                    DEFERRED_TASKS.append(task)
+                    if task['status'] != "Deferred":
+                        set_task_status(task, "Deferred", "Disk/RAM ඉඩ ලැබෙන තුරු රැඳී සිටී")
+                        for waiter in task['waiters']:
+                            try:
+                                if not await ensure_status_message(waiter): continue
+                                await waiter['status_message'].edit_text("⏸️ Server එකේ ඉඩ මදි නිසා ඔබගේ ඉල්ලීම තාවකාලිකව පසුවට දමා ඇත. ඉඩ ලැබුණු විගස ආරම්භ වේ.")
+                            except Exception:
+                                pass
+                    continue
+                set_task_status(task, "Downloading")
+                observe_stage('queue_wait', time.time() - task['added_time'])
 
-            ydl_opts = {'outtmpl': f'downloads/{task_id} - %(title)s.%(ext)s', 'quiet': True, 'progress_hooks': [partial(download_progress_hook, status_message=status_message, task_id=task_id)]}
-            
-            if task.get('is_button_click'):
-                if task['media_type'] == 'audio':
-                    ydl_opts.update({'format': task['format_id'], 'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'}]})
+                ydl_job = {'outtmpl': f'downloads/{task_id} - %(title)s.%(ext)s'}
+                if task.get('is_button_click'):
+                    kind = 'audio' if task['media_type'] == 'audio' else 'video'
+                    ydl_job.update({'profile': (kind, wants_cookies(url)), 'format': task['format_id']})
                 else:
-                    ydl_opts.update({'format': task['format_id'], 'merge_output_format': 'mp4'})
-            else:
-                ydl_opts.update({'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best', 'merge_output_format': 'mp4'})
+                    ydl_job.update({'profile': ('video', wants_cookies(url)), 'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'})
 
-            if "youtube.com" in url or "youtu.be" in url and os.path.exists(COOKIES_FILE_PATH):
-                ydl_opts['cookiefile'] = COOKIES_FILE_PATH
-            
-            downloaded_files = []
+                task['files'] = []
+                started = time.time()
+                if task['direct']:
+                    try:
+                        info_dict, task['filepath'], pp_seconds = await segmented_download(task, task['direct'])
+                    except import_yt_dlp().utils.DownloadCancelled:
+                        raise
+                    except Exception as e:
+                        logger.warning(f"Segmented download of {url} failed, falling back to yt-dlp: {e}")
+                        partial_files = task['files']
+                        task['files'], task['direct'] = [], None
+                        for f in partial_files:
+                            if os.path.exists(f): os.remove(f)
+                if not task['direct']:
+                    info_dict, task['filepath'], pp_seconds = await download_with_cached_info(task, ydl_job)
+                    task['files'].append(task['filepath'])
+                if not os.path.exists(task['filepath']):
+                    raise FileNotFoundError(f"yt-dlp did not produce a file (larger than {humanbytes(MAX_DOWNLOAD_SIZE)}?)" if MAX_DOWNLOAD_SIZE else "yt-dlp did not produce a file")
+                observe_stage('download', time.time() - started - pp_seconds, os.path.getsize(task['filepath']))
+                if pp_seconds: observe_stage('postprocess', pp_seconds)
+                if os.path.getsize(task['filepath']) > TG_MAX_UPLOAD:
+                    if not can_split(task):
+                        raise RuntimeError(f"File is larger than Telegram's {humanbytes(TG_MAX_UPLOAD)} limit and cannot be split")
+                    set_task_status(task, "Splitting")
+                    task['info_dict'] = info_dict
+                    started = time.time()
+                    task['parts'] = await split_media(task)
+                    observe_stage('postprocess', time.time() - started)
+                    task['files'].remove(task['filepath'])
+                    os.remove(task['filepath'])
+                # The file is on disk now, so free space already accounts for it.
+                release_reservation(task)
+                task['info_dict'] = info_dict
+                set_task_status(task, "Downloaded", "Upload එක සඳහා රැඳී සිටී")
+                task['worker'] = None
+                # Bounded hand-off: blocks this download slot while the upload stage is saturated.
+                await UPLOAD_QUEUE.put(task)
+            except Exception as e:
+                await fail_task(task, e)
+                cleanup_files(task)
+                for f in os.listdir('downloads'):
+                    if f.startswith(f"{task_id} - "): os.remove(os.path.join('downloads', f))
+        except Exception as e:
+            logger.error(f"Major error in download worker #{worker_id}: {e}")
+        finally:
+            await DOWNLOAD_LIMITER.release()
+
+async def upload_file(task, waiter, caption, duration):
+    message = waiter['message']
+    filepath = task['filepath']
+    progress = partial(upload_progress, task)
+    if task.get('media_type') == 'audio':
+        return await message.reply_audio(audio=filepath, caption=caption, duration=duration, progress=progress)
+    elif task.get('media_type') == 'video' or duration > 0:
+        return await message.reply_video(video=filepath, caption=caption, duration=duration, progress=progress)
+    elif task.get('media_type') == 'document':
+        return await message.reply_document(document=filepath, caption=caption, progress=progress)
+    else:
+        return await message.reply_photo(photo=filepath, caption=caption, progress=progress)
+
+async def upload_worker(worker_id):
+    logger.info(f"Upload worker #{worker_id} started.")
+    while True:
+        await UPLOAD_LIMITER.acquire()
+        try:
+            task = await UPLOAD_QUEUE.get()
+            info_dict = task['info_dict']
+
+            task['worker'] = f"U{worker_id}"
+            set_task_status(task, "Uploading")
             try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info_dict = await asyncio.to_thread(ydl.extract_info, url, download=True)
-                    filepath = ydl.prepare_filename(info_dict)
-                    downloaded_files.append(filepath)
-
-                    ACTIVE_TASKS[task_id]['status'] = "Uploading"
-                    
-                    caption = info_dict.get('description') or info_dict.get('title', '')
-                    duration = int(info_dict.get('duration', 0))
-
-                    if task.get('media_type') == 'audio':
-                        await message.reply_audio(audio=filepath, caption=caption[:1024], duration=duration, progress=partial(progress_callback, "📤 Upload කරමින්...", status_message))
-                    elif duration > 0:
-                        await message.reply_video(video=filepath, caption=caption[:1024], duration=duration, progress=partial(progress_callback, "📤 Upload කරමින්...", status_message))
-                    else:
-                        await message.reply_photo(photo=filepath, caption=caption[:1024], progress=partial(progress_callback, "📤 Upload කරමින්...", status_message))
-                    
-                    await status_message.delete()
-                    if task_id in ACTIVE_TASKS: del ACTIVE_TASKS[task_id]
+                caption = (info_dict.get('description') or info_dict.get('title', ''))[:1024]
+                duration = int(info_dict.get('duration') or 0)
+
+                media_group = None
+                if task.get('parts'):
+                    started = time.time()
+                    media_group = await upload_parts(task, caption)
+                    observe_stage('upload', time.time() - started, sum(os.path.getsize(p) for p in task['parts']))
+                file_id = None
+                # Waiters may still attach while we upload; each one leaves the list once it is served or has failed.
+                while task['waiters']:
+                    waiter = task['waiters'][0]
+                    try:
+                        await ensure_status_message(waiter)
+                        if media_group:
+                            await send_media_parts(waiter['message'], media_group)
+                            await finish_waiter(waiter)
+                            continue
+                        if file_id:
+                            try:
+                                await waiter['message'].reply_cached_media(file_id, caption=caption)
+                                await finish_waiter(waiter)
+                                continue
+                            except Exception as e:
+                                logger.warning(f"Resending {file_id} to waiter {waiter['id']} failed, uploading instead: {e}")
+                        started = time.time()
+                        sent = await upload_file(task, waiter, caption, duration)
+                        observe_stage('upload', time.time() - started, os.path.getsize(task['filepath']))
+                        if not file_id:
+                            file_id = sent_file_id(sent)
+                            if file_id:
+                                file_cache_put(task['cache_key'], task.get('media_type', 'auto'), file_id, os.path.getsize(task['filepath']), caption)
+                        await finish_waiter(waiter)
+                    except Exception as e:
+                        # A blocked bot or a deleted message only costs this waiter its copy.
+                        logger.error(f"Delivering task {task['id']} to waiter {waiter['id']} failed. Error: {e}")
+                        await fail_waiter(task, waiter, e)
+                    finally:
+                        if waiter in task['waiters']: task['waiters'].remove(waiter)
+                release_task(task)
             except Exception as e:
-                logger.error(f"Task {task_id} failed. Error: {e}")
-                if task_id in ACTIVE_TASKS: ACTIVE_TASKS[task_id]['status'] = "Error"
-                await status_message.edit_text(f"❌ **බාගත කිරීමේ දෝෂයකි!**\n\nURL: `{url}`\nError: `{e}`")
+                await fail_task(task, e)
             finally:
-                for f in downloaded_files:
-                    if os.path.exists(f): os.remove(f)
+                # Only now has the last waiter been served.
+                cleanup_files(task)
         except Exception as e:
-            logger.error(f"Major error in queue worker: {e}")
+            logger.error(f"Major error in upload worker #{worker_id}: {e}")
+        finally:
+            await UPLOAD_LIMITER.release()
 
 # --- 5. Pyrogram Event Handlers ---
 @app.on_message(filters.command("start"))
@@ -200,13 +1510,18 @@ async def link_handler(client, message):
     if not url_match: return
     url = url_match.group(0)
 
-    if "youtube.com" in url or "youtu.be" in url:
+    if is_playlist_url(url):
+        # The event loop only keeps a weak reference to tasks; hold on to the listing until it is done.
+        listing = asyncio.create_task(ingest_playlist(message, url))
+        PLAYLIST_TASKS.add(listing)
+        listing.add_done_callback(PLAYLIST_TASKS.discard)
+    elif "youtube.com" in url or "youtu.be" in url:
         status_message = await message.reply_text("🔎 YouTube link එකක් හඳුනාගත්තා. Format විස්තර ලබාගනිමින්...", quote=True)
-        ydl_opts = {'quiet': True}
-        if os.path.exists(COOKIES_FILE_PATH): ydl_opts['cookiefile'] = COOKIES_FILE_PATH
+        id_match = re.search(YOUTUBE_ID_REGEX, url)
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info_dict = await asyncio.to_thread(ydl.extract_info, url, download=False)
+            info_dict = await extract_info_cached(url, ('info', wants_cookies(url)), id_match.group(1) if id_match else None)
+            if not id_match and info_dict.get('id'):
+                info_cache_put(info_dict['id'], info_dict)
             keyboard = await create_quality_keyboard(info_dict)
             if keyboard:
                 await status_message.edit_text(f"**🎥 Video:** `{info_dict.get('title', 'N/A')}`\n\nකරුණාකර බාගත කිරීමට අවශ්‍ය format එක තෝරන්න:", reply_markup=keyboard)
@@ -216,10 +1531,12 @@ async def link_handler(client, message):
             await status_message.edit_text(f"❌ Format විස්තර ලබාගැනීමේදී දෝෂයක් ඇතිවිය: `{e}`")
     else:
         task_id = str(uuid.uuid4())[:8]
-        task = {'id': task_id, 'url': url, 'message': message, 'status': 'Pending', 'status_detail': '', 'added_time': time.time()}
-        await TASK_QUEUE.put(task)
-        ACTIVE_TASKS[task_id] = task
-        await message.reply_text(f"✅ ඉල්ලීම පෝලිමට ඇතුළත් කරන ලදී.\nTask ID: `{task_id}`", quote=True)
+        task = {'id': task_id, 'url': url, 'message': message, 'user_id': message.chat.id, 'status': 'Pending', 'status_detail': '', 'added_time': time.time(), 'cache_key': media_cache_key(url)}
+        primary = await enqueue_task(task)
+        if primary is task:
+            await message.reply_text(f"✅ ඉල්ලීම පෝලිමට ඇතුළත් කරන ලදී.\nTask ID: `{task_id}`", quote=True)
+        else:
+            await message.reply_text(f"✅ මෙම link එක දැනටමත් බාගත වෙමින් පවතී. ඔබගේ ඉල්ලීම එයට සම්බන්ධ කරන ලදී.\nTask ID: `{task_id}` (→ `{primary['id']}`)", quote=True)
 
 @app.on_callback_query(filters.regex(r"^download:"))
 async def button_handler(client, callback_query: CallbackQuery):
@@ -233,177 +1550,153 @@ async def button_handler(client, callback_query: CallbackQuery):
     task_id = str(uuid.uuid4())[:8]
     task = {
         'id': task_id, 'url': url, 'message': callback_query.message.reply_to_message,
+        'user_id': callback_query.from_user.id if callback_query.from_user else callback_query.message.chat.id,
         'status': 'Pending', 'status_detail': '', 'added_time': time.time(),
-        'is_button_click': True, 'media_type': media_type, 'format_id': format_id,
-        'status_message_for_edit': callback_query.message
+        'is_button_click': True, 'media_type': media_type, 'format_id': format_id, 'video_id': video_id,
+        'status_message_for_edit': callback_query.message, 'cache_key': media_cache_key(url, format_id, media_type),
+        'expected_size': expected_download_size(video_id, format_id)
     }
-    await TASK_QUEUE.put(task)
-    ACTIVE_TASKS[task_id] = task
+    if await send_cached_media(task):
+        return await callback_query.message.delete()
+    if MAX_DOWNLOAD_SIZE and task['expected_size'] > MAX_DOWNLOAD_SIZE:
+        return await callback_query.message.edit_text(f"❌ මෙම format එක ({humanbytes(task['expected_size'])}) උපරිම ප්‍රමාණය ({humanbytes(MAX_DOWNLOAD_SIZE)}) ඉක්මවයි. කරුණාකර කුඩා format එකක් තෝරන්න.")
+    await enqueue_task(task)
 
 @app.on_message(filters.command("list"))
 async def list_command(client, message):
     if not ACTIVE_TASKS:
         return await message.reply_text("🙂 පෝලිම හිස් ය.")
-    response = "**📑 වත්මන් බාගත කිරීමේ පෝලිම:**\n\n"
-    for task_id, task in list(ACTIVE_TASKS.items()):
-        status_icon = {"Pending": "⏳", "Downloading": "📥", "Uploading": "📤", "Error": "❌"}.get(task['status'], "❓")
+    positions = TASK_QUEUE.positions()
+    response = f"**📑 වත්මන් බාගත කිරීමේ පෝලිම:** (Download: `{DOWNLOAD_LIMITER.limit}/{MAX_WORKERS}` | Upload: `{UPLOAD_LIMITER.limit}/{MAX_UPLOAD_WORKERS}`)\n\n"
+    for playlist_id, playlist in list(PLAYLISTS.items()):
+        response += f"📃 **Playlist** `{playlist_id}` - `{playlist['title'][:40]}`\n   - ✅ `{playlist['done']}` | ❌ `{playlist['failed']}` | 📑 `{playlist['queued']}`{' (listing...)' if playlist['listing'] else ''}\n\n"
+    tasks = sorted(ACTIVE_TASKS.items(), key=lambda item: positions.get(item[0], 0))
+    for task_id, task in tasks:
+        status_icon = {"Pending": "⏳", "Deferred": "⏸️", "Downloading": "📥", "Splitting": "✂️", "Downloaded": "📦", "Uploading": "📤", "Error": "❌"}.get(task['status'], "❓")
         url_short = task['url'][:40] + '...' if len(task['url']) > 40 else task['url']
-        response += f"{status_icon} **{task['status']}** - `{task['status_detail']}`\n   - ID: `{task_id}` | URL: `{url_short}`\n\n"
+        if task.get('playlist_id'):
+            url_short = f"📃 {task['playlist_id']} - {(task.get('title') or task['url'])[:40]}"
+        if task_id in positions:
+            slot = f"Position: `#{positions[task_id]}`"
+        elif task.get('attached_to'):
+            slot = f"Attached: `{task['attached_to']}`"
+        else:
+            slot = f"Worker: `{task['worker']}`" if task.get('worker') else "Worker: `-`"
+        response += f"{status_icon} **{task['status']}** - `{progress_detail(task)}`\n   - ID: `{task_id}` | {slot} | URL: `{url_short}`\n\n"
     await message.reply_text(response)
 
 @app.on_message(filters.command("status"))
 async def status_command(client, message):
     status_msg = await message.reply_text("📊 Server තත්ත්වය ලබාගනිමින් පවතී...")
-    cpu = await asyncio.to_thread(psutil.cpu_percent, interval=1)
-    ram = await asyncio.to_thread(psutil.virtual_memory)
-    disk = await asyncio.to_thread(psutil.disk_usage, '/')
+    cpu = SYSTEM_STATS['cpu']
+    ram = SYSTEM_STATS['ram'] or await asyncio.to_thread(psutil.virtual_memory)
+    disk = SYSTEM_STATS['disk'] or await asyncio.to_thread(psutil.disk_usage, '/')
     uptime = get_readable_time(time.time() - BOT_START_TIME)
+    startup = f"`{STARTUP_STATS.get('connected', 0):.1f}s`"
+    if 'yt_dlp_ready' in STARTUP_STATS: startup += f" (yt-dlp ready after `{STARTUP_STATS['yt_dlp_ready']:.1f}s` more)"
     response = (
-        f"**🤖 BOT STATUS**\n  - **Uptime:** `{uptime}`\n\n"
+        f"**🤖 BOT STATUS**\n  - **Uptime:** `{uptime}`\n"
+        f"  - **Startup:** {startup}\n"
+        f"  - **YoutubeDL pool:** `{sum(len(idle) for idle in YDL_POOL.values())}` idle | `{YDL_POOL_STATS['created']}` created | `{YDL_POOL_STATS['reused']}` reused | `{YDL_POOL_STATS['discarded']}` discarded\n\n"
         f"**🖥️ SERVER STATUS**\n"
         f"  - **CPU:** `{cpu}%`\n"
         f"  - **RAM:** `{ram.percent}%` ({humanbytes(ram.used)}/{humanbytes(ram.total)})\n"
-        f"  - **Disk:** `{disk.percent}%` ({humanbytes(disk.used)}/{humanbytes(disk.total)})"
+        f"  - **Disk:** `{disk.percent}%` ({humanbytes(disk.used)}/{humanbytes(disk.total)})\n"
+        f"  - **Reserved:** `{humanbytes(sum(DISK_RESERVATIONS.values())) or '0 B'}` for `{len(DISK_RESERVATIONS)}` downloads"
+        f" | **Deferred:** `{sum(1 for t in ACTIVE_TASKS.values() if t['status'] == 'Deferred')}`\n\n"
+        f"**🗂️ INFO CACHE**\n"
+        f"  - **Entries:** `{len(INFO_CACHE)}/{INFO_CACHE_SIZE}`\n"
+        f"  - **Hits/Misses:** `{INFO_CACHE_STATS['hits']}/{INFO_CACHE_STATS['misses']}` (expired: `{INFO_CACHE_STATS['expired']}`)\n"
+        f"  - **Time saved:** `~{get_readable_time(info_cache_saved_time())}`"
     )
     await status_msg.edit_text(response)
     
-@app.on_message(filters.command("ping"))
-async def ping_command(client, message):
-    start_time = time.time()
-    ping_msg = await message.reply_text("🏓 Pinging...")
-    latency = round((time.time() - start_time) * 1000, 2)
-    await ping_msg.edit_text(f"**🏓 Pong!**\n`{latency} ms`")
-
-@app.on_message(filters.command("speedtest"))
-async def speedtest_command(client, message):
-    speed_msg = await message.reply_text("🌐 වේග පරීක්ෂණයක් ආරම්භ කරමින්... මෙය මිනිත්තුවක් පමණ ගතවිය හැක.")
-    try:
-        result_bytes = await asyncio.to_thread(subprocess.check_output, ['speedtest-cli', '--json'])
-        result = json.loads(result_bytes)
-        response = (
-            f"**🌐 වේග පරීක්ෂණයේ ප්‍රතිඵල:**\n\n"
-            f"  - **Server:** `{result['server']['name']}`\n"
-            f"  - **Ping:** `{result['ping']:.2f} ms`\n"
-            f"  - **Download:** `{humanbytes(result['download'])}/s`\n"
-            f"  - **Upload:** `{humanbytes(result['upload'])}/s`"
-        )
-        await speed_msg.edit_text(response)
-    except Exception as e:
-        await speed_msg.edit_text(f"❌ වේග පරීක්ෂණය අසාර්ථක විය. `speedtest-cli` ස්ථාපනය කර ඇත්දැයි බලන්න.\n`{e}`")
-
-# --- 6. Main Execution Block ---
-async def main():
-    await app.start()
-    logger.info("Bot started.")
-    asyncio.create_task(queue_worker())
-    logger.info("Queue worker started.")
-    await asyncio.Event().wait()
-    await app.stop()
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        logger.info("Bot stopping...")us_command, ping_command, speedtest_command) ...
-# ... (main execution block) ...
-
-# NOTE: The provided code snippet is a significant modification. 
-# You need to integrate these new functions (`create_quality_keyboard`, `button_handler`)
-# and modifications (`link_handler`, `queue_worker`) into your existing `main.py` script.
-# The command handlers (/status, etc.) and the main execution part do not need to change.
-# The placeholder `... [Paste the ... block from the PREVIOUS main.py here] ...` should
-# be replaced with the corresponding code block.
-
-# --- Command Handlers (Unchanged) ---
-@app.on_message(filters.command("start"))
-async def start_command(client, message):
-    await message.reply_text("👋 Hi! I'm an advanced media downloader bot.\n- Send me a YouTube link for quality options.\n- Use /list to see the queue.\n- Use /status for server stats.")
-
-@app.on_message(filters.command("list"))
-# ... (code is the same as before)
-async def list_command(client, message):
-    if not ACTIVE_TASKS:
-        await message.reply_text("🙂 පෝලිම හිස් ය.")
-        return
-
-    response = "**📑 වත්මන් බාගත කිරීමේ පෝලිම:**\n\n"
-    for task_id, task in ACTIVE_TASKS.items():
-        status_icon = "⏳"
-        if task['status'] == 'Downloading': status_icon = "📥"
-        elif task['status'] == 'Uploading': status_icon = "📤"
-        elif task['status'] == 'Error': status_icon = "❌"
-        
-        url_short = task['url'][:40] + '...' if len(task['url']) > 40 else task['url']
-        response += f"{status_icon} **{task['status']}** - `{task['status_detail']}`\n"
-        response += f"   - ID: `{task_id}`\n"
-        response += f"   - URL: `{url_short}`\n\n"
-        
+@app.on_message(filters.command("cachestats") & filters.user(ADMIN_IDS))
+async def cachestats_command(client, message):
+    stats = file_cache_stats()
+    hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+    hit_rate = hits * 100 / (hits + misses) if hits + misses else 0
+    response = (
+        f"**📦 RESULT CACHE**\n"
+        f"  - **Entries:** `{stats['entries']}/{FILE_CACHE_MAX_ENTRIES}`\n"
+        f"  - **Hit rate:** `{hit_rate:.1f}%` ({hits} hits / {misses} misses)\n"
+        f"  - **Invalidated:** `{stats.get('invalidations', 0)}`\n"
+        f"  - **Bytes saved:** `{humanbytes(stats.get('bytes_saved', 0)) or '0 B'}`"
+    )
     await message.reply_text(response)
 
-@app.on_message(filters.command("status"))
-# ... (code is the same as before)
-async def status_command(client, message):
-    status_msg = await message.reply_text("📊 Server තත්ත්වය ලබාගනිමින් පවතී...")
-    
-    cpu_usage = await asyncio.to_thread(psutil.cpu_percent, interval=1)
-    ram = await asyncio.to_thread(psutil.virtual_memory)
-    disk = await asyncio.to_thread(psutil.disk_usage, '/')
-    uptime = get_readable_time(time.time() - BOT_START_TIME)
-    
+@app.on_message(filters.command("metrics") & filters.user(ADMIN_IDS))
+async def metrics_command(client, message):
+    workers = active_workers()
     response = (
-        f"**🤖 BOT STATUS**\n"
-        f"  - **Uptime:** `{uptime}`\n\n"
-        f"**🖥️ SERVER STATUS**\n"
-        f"  - **CPU Usage:** `{cpu_usage}%`\n"
-        f"  - **RAM Usage:** `{ram.percent}%` ({humanbytes(ram.used)} / {humanbytes(ram.total)})\n"
-        f"  - **Disk Usage:** `{disk.percent}%` ({humanbytes(disk.used)} / {humanbytes(disk.total)})"
+        f"**📈 METRICS**\n"
+        f"  - **Queue:** `{TASK_QUEUE.qsize()}` download | `{UPLOAD_QUEUE.qsize()}` upload\n"
+        f"  - **Active workers:** `{workers['download']}/{DOWNLOAD_LIMITER.limit}` download | `{workers['upload']}/{UPLOAD_LIMITER.limit}` upload\n"
+        f"  - **Tasks:** `{METRICS['tasks']['ok']}` ok | `{METRICS['tasks']['error']}` failed\n\n"
+        f"**⏱️ STAGES** (count | avg | p50 | p95 | rate)\n"
     )
-    
-    await status_msg.edit_text(response)
+    for stage, histogram in METRICS['stage_seconds'].items():
+        nbytes = METRICS['stage_bytes'].get(stage, 0)
+        rate = f"{humanbytes(nbytes / histogram['sum'])}/s" if nbytes and histogram['sum'] else "-"
+        response += f"  - **{stage}:** `{histogram['count']}` | `{histogram['sum'] / histogram['count']:.1f}s` | `≤{histogram_quantile(histogram, 0.5)}s` | `≤{histogram_quantile(histogram, 0.95)}s` | `{rate}`\n"
+    if METRICS['errors']:
+        response += "\n**❌ ERRORS**\n" + "".join(f"  - **{extractor}:** `{count}`\n" for extractor, count in sorted(METRICS['errors'].items(), key=lambda item: -item[1]))
+    await message.reply_text(response)
 
 @app.on_message(filters.command("ping"))
-# ... (code is the same as before)
 async def ping_command(client, message):
     start_time = time.time()
     ping_msg = await message.reply_text("🏓 Pinging...")
-    end_time = time.time()
-    latency = round((end_time - start_time) * 1000, 2)
+    latency = round((time.time() - start_time) * 1000, 2)
     await ping_msg.edit_text(f"**🏓 Pong!**\n`{latency} ms`")
 
 @app.on_message(filters.command("speedtest"))
-# ... (code is the same as before)
 async def speedtest_command(client, message):
-    speed_msg = await message.reply_text("🌐 වේග පරීක්ෂණයක් ආරම්භ කරමින්... මෙය මිනිත්තුවක් පමණ ගතවිය හැක.")
-    try:
-        result_bytes = await asyncio.to_thread(subprocess.check_output, ['speedtest-cli', '--json'])
-        result_json = json.loads(result_bytes)
-        
-        download_speed = humanbytes(result_json['download']) + '/s'
-        upload_speed = humanbytes(result_json['upload']) + '/s'
-        ping = f"{result_json['ping']:.2f} ms"
-        client_ip = result_json['client']['ip']
-        server_name = result_json['server']['name']
-
-        response = (
-            f"**🌐 වේග පරීක්ෂණයේ ප්‍රතිඵල:**\n\n"
-            f"  - **Server:** `{server_name}`\n"
-            f"  - **IP:** `{client_ip}`\n"
-            f"  - **Ping:** `{ping}`\n"
-            f"  - **Download:** `{download_speed}`\n"
-            f"  - **Upload:** `{upload_speed}`"
+    # Live numbers from real transfers, measured by the concurrency controller every CONCURRENCY_INTERVAL seconds.
+    response = f"**🌐 සජීවී වේගය** (අවසන් තත්පර `{CONCURRENCY_INTERVAL:g}`)\n\n"
+    for stage, label in (('download', "📥 Download"), ('upload', "📤 Upload")):
+        state = CONCURRENCY[stage]
+        rate = f"{humanbytes(state['rate'])}/s" if state['rate'] else "තවම දත්ත නැත"
+        response += (
+            f"**{label}:** `{rate}` (ඉහළම: `{humanbytes(state['peak']) or '0 B'}/s`)\n"
+            f"  - **Workers:** `{state['limiter'].limit}/{state['max']}`" + (" (adaptive)" if ADAPTIVE_CONCURRENCY else "") + "\n"
         )
-        await speed_msg.edit_text(response)
-    except Exception as e:
-        logger.error(f"Speedtest failed: {e}")
-        await speed_msg.edit_text(f"❌ වේග පරීක්ෂණය අසාර්ථක විය. `speedtest-cli` ඔබගේ server එකේ ස්ථාපනය කර ඇත්දැයි පරීක්ෂා කරන්න.\n`{e}`")
+        if state['last_decision']:
+            response += f"  - **Controller:** {state['last_decision'][1]} (`{get_readable_time(time.time() - state['last_decision'][0])}` ago)\n"
+        response += "\n"
+    await message.reply_text(response.strip())
+
+# --- 6. Main Execution Block ---
+async def start_workers():
+    asyncio.create_task(progress_renderer())
+    asyncio.create_task(housekeeping_loop())
+    asyncio.create_task(system_sampler())
+    asyncio.create_task(admission_loop())
+    if METRICS_PORT:
+        await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    await recover_tasks()
+    for worker_id in range(1, MAX_WORKERS + 1):
+        asyncio.create_task(download_worker(worker_id))
+    for worker_id in range(1, MAX_UPLOAD_WORKERS + 1):
+        asyncio.create_task(upload_worker(worker_id))
+    asyncio.create_task(concurrency_controller())
+    logger.info(f"{MAX_WORKERS} download workers and {MAX_UPLOAD_WORKERS} upload workers started, {DOWNLOAD_LIMITER.limit} and {UPLOAD_LIMITER.limit} allowed to run" + (" (adaptive)." if ADAPTIVE_CONCURRENCY else "."))
 
-# --- Main Execution (Unchanged) ---
 async def main():
-    async with app:
-        # Start the queue worker as a background task
-        asyncio.create_task(queue_worker())
-        logger.info("Bot and Queue Worker have started.")
-        await asyncio.Event().wait() # Keep the bot running indefinitely
+    file_cache_init()
+    journal_open()
+    start_job_pool()
+    sweep_stale_files(min_age=0)
+    await app.start()
+    STARTUP_STATS['connected'] = time.perf_counter() - STARTUP_T0
+    logger.info(f"Bot started in {STARTUP_STATS['connected']:.2f}s (imports {STARTUP_STATS['imports']:.2f}s).")
+    if JOB_POOL is None:
+        # Worker processes warm their own pools; in thread mode the instances live here.
+        asyncio.create_task(warm_up_yt_dlp())
+    await start_workers()
+    await asyncio.Event().wait()
+    await app.stop()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import importlib
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+FILE_SIZE = 3 * 1024 * 1024 + 12345
+PAYLOAD = os.urandom(FILE_SIZE)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    # /ranges/ serves byte ranges, /drop/ cuts the first few responses short,
+    # /ignore/ advertises ranges but always answers 200 with the whole file.
+    protocol_version = 'HTTP/1.1'
+    drops_left = 3
+    dropped = []
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send_headers(self):
+        mode = self.path.split('/')[1]
+        start, end = 0, FILE_SIZE - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and mode != 'ignore':
+            start, end = int(match.group(1)), int(match.group(2) or end)
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{FILE_SIZE}")
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return mode, start, end
+
+    def do_HEAD(self):
+        self.send_headers()
+
+    def do_GET(self):
+        mode, start, end = self.send_headers()
+        with self.lock:
+            drop = mode == 'drop' and MediaHandler.drops_left > 0
+            if drop:
+                MediaHandler.drops_left -= 1
+                self.dropped.append(start)
+        if drop:
+            self.wfile.write(PAYLOAD[start:start + 64 * 1024])
+            self.close_connection = True
+            return
+        try:
+            self.wfile.write(PAYLOAD[start:end + 1])
+        except ConnectionError:
+            pass  # the client hung up after seeing a 200
+
+
+@pytest.fixture(scope='module')
+def main(tmp_path_factory):
+    os.environ.update(API_ID='1', API_HASH='x', BOT_TOKEN='1:x', SEGMENTED_MIN_SIZE_MB='1', SEGMENTED_CONNECTIONS='3')
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('bot'))
+    try:
+        yield importlib.import_module('main')
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+def new_task(task_id):
+    return {'id': task_id, 'files': [], 'waiters': []}
+
+
+def download(main, url, task):
+    direct = main.probe_direct_link(url)
+    assert direct and direct['size'] == FILE_SIZE and direct['media_type'] == 'video'
+    return asyncio.run(main.segmented_download(task, direct))
+
+
+def test_segmented_download_matches_source(main, server):
+    before = main.THROUGHPUT['download']
+    info, path, _ = download(main, f"{server}/ranges/clip.mp4", new_task('seg1'))
+    with open(path, 'rb') as f:
+        assert hashlib.sha256(f.read()).digest() == hashlib.sha256(PAYLOAD).digest()
+    assert info['title'] == 'clip' and info['ext'] == 'mp4'
+    assert main.THROUGHPUT['download'] - before == FILE_SIZE
+
+
+def test_segmented_download_resumes_dropped_connections(main, server):
+    info, path, _ = download(main, f"{server}/drop/clip.mp4", new_task('seg2'))
+    with open(path, 'rb') as f:
+        assert hashlib.sha256(f.read()).digest() == hashlib.sha256(PAYLOAD).digest()
+    assert len(MediaHandler.dropped) == 3
+
+
+def test_server_ignoring_range_fails_without_retries(main, server):
+    started = time.time()
+    with pytest.raises(main.RangeNotSupported):
+        download(main, f"{server}/ignore/clip.mp4", new_task('seg3'))
+    assert time.time() - started < 5